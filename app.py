@@ -2,80 +2,444 @@ import streamlit as st
 import PyPDF2
 import re
 import json
+import orjson
 from datetime import datetime
 import time
-from fpdf import FPDF
 import io
+import os
+import stat
+import hashlib
+import tempfile
+import threading
+import importlib.util
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-# Intentar importar Gemini
+# Intentar importar pypdfium2 (motor de extracción principal)
 try:
-    import google.generativeai as genai
-    from google.api_core import exceptions
-    GEMINI_AVAILABLE = True
+    import pypdfium2 as pdfium
+    PDFIUM_AVAILABLE = True
+except ImportError:
+    PDFIUM_AVAILABLE = False
+# PDFium no es thread-safe ni siquiera entre documentos distintos, y Streamlit ejecuta
+# cada sesión en su propio hilo: todo uso de pypdfium2 pasa por este candado
+_PDFIUM_LOCK = threading.Lock()
+
+# Comprobar si Gemini está instalado sin importarlo: google-generativeai arrastra grpc y
+# protobuf, así que solo se carga (con cargar_gemini) cuando de verdad se usa la IA
+try:
+    GEMINI_AVAILABLE = importlib.util.find_spec("google.generativeai") is not None
 except ImportError:
     GEMINI_AVAILABLE = False
+if not GEMINI_AVAILABLE:
     st.warning("Para usar análisis con IA, instala 'google-generativeai' (pip install google-generativeai)")
 
+# Máximo de caracteres de la historia que se envían a Gemini en la extracción por IA
+MAX_CARACTERES_IA = 200000
+
+# Por debajo de este promedio de letras por página el PDF se considera escaneado (sin capa de texto)
+MIN_LETRAS_POR_PAGINA = 40
+
+# Por encima de este tamaño el texto completo no se envía tal cual al análisis:
+# se resume por fragmentos y se analizan los resúmenes
+MAX_CARACTERES_ANALISIS = 100000
+
+# Tamaño de cada fragmento enviado a Gemini y cuántas llamadas se hacen a la vez
+TAMANO_FRAGMENTO_IA = 40000
+MAX_LLAMADAS_IA_PARALELAS = 4
+
+# Elementos por página en las secciones largas del reporte
+TAMANO_PAGINA = 25
+
+# Caché en disco de textos extraídos y resultados de IA, indexada por el SHA-256 del PDF.
+# Guarda datos clínicos: cada entrada vence a las CACHE_TTL_SEGUNDOS y, si el total pasa
+# de CACHE_MAX_BYTES, se borran primero las más antiguas. Vive en la carpeta de caché
+# del usuario (no en /tmp, compartido) y solo se usa si es privada (ver cache_privada)
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "hc_cache"
+CACHE_TTL_SEGUNDOS = 24 * 60 * 60
+CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+# ----------------------------------------------------------------------
+# Patrones precompilados (se compilan una sola vez al cargar el módulo)
+# ----------------------------------------------------------------------
+_RE_LINEAS_VACIAS = re.compile(r'\n\s*\n')
+# Caracteres de control (salvo \t, \n y \r) que algunos motores PDF dejan en el texto.
+# El salto de página (\f) y el tabulador vertical (\v) separan líneas: se convierten
+# en \n en vez de borrarse, para no pegar el final de una página con la siguiente
+_TABLA_CONTROL = dict.fromkeys([*range(0, 9), *range(14, 32), 127])
+_TABLA_CONTROL.update({11: '\n', 12: '\n'})
+
+_RE_DOCUMENTO = re.compile(r'CC\s*(\d+)')
+_RE_NOMBRE = re.compile(r'--\s*([A-ZÁÉÍÓÚÑ\s]+?)\s+Fec\.\s*Nacimiento')
+_RE_FECHA_NACIMIENTO = re.compile(r'Fec\.\s*Nacimiento:\s*(\d{2}/\d{2}/\d{4})')
+_RE_EDAD = re.compile(r'Edad\s*actual:\s*(\d+)\s*AÑOS')
+_RE_TELEFONO = re.compile(r'Teléfono:\s*(\d+)')
+_RE_DIRECCION = re.compile(r'Dirección:\s*([^\n]+)')
+
+_RE_SERVICIO = re.compile(
+    r'SEDE DE ATENCION\s+(\d+)\s+([^\n]+?)\s+FOLIO\s+\d+\s+FECHA\s+(\d{2}/\d{2}/\d{4})\s+(\d{2}:\d{2}:\d{2})\s+TIPO DE ATENCION\s*:\s*([^\n]+)',
+    re.IGNORECASE
+)
+
+_RE_DIAGNOSTICO = re.compile(r'(?:DIAGN[OÓ]STICO|DX|DIAGN[OÓ]STICOS?)\s*:?\s*([A-Z0-9]+\s+[^\n]+)', re.IGNORECASE)
+_RE_CODIGO_CIE10 = re.compile(r'([A-Z]\d{2,3})')
+
+# Fin de bloque: siguiente línea en mayúsculas (encabezado de otra sección)
+_RE_FIN_BLOQUE = re.compile(r'\n[A-Z ]{5,}\n')
+_RE_FECHA = re.compile(r'(\d{2}/\d{2}/\d{4})')
+_RE_FECHA_HORA = re.compile(r'(\d{2}/\d{2}/\d{4})\s+(\d{2}:\d{2}:\d{2})')
+
+_RE_CONCILIACION = re.compile(r'CONCILIACI[OÓ]N MEDICAMENTOSA', re.IGNORECASE)
+_RE_PLAN_TERAPEUTICO = re.compile(r'PLAN\s*[-:]?\s*TERAPEUTICO', re.IGNORECASE)
+# Mismos encabezados para buscar sobre texto.lower(): sin IGNORECASE el motor salta
+# directo al literal inicial en vez de probar cada posición
+_RE_CONCILIACION_MIN = re.compile(r'conciliaci[oó]n medicamentosa')
+_RE_PLAN_TERAPEUTICO_MIN = re.compile(r'plan\s*[-:]?\s*terapeutico')
+_RE_LINEA_MEDICAMENTO = re.compile(r'^\s*\d+\.?\d*\s+[A-Za-z0-9]')
+_RE_CANTIDAD = re.compile(r'^\d+\.?\d*$')
+_RE_DOSIS_FORMULA = re.compile(r'(\d+[.,]?\d*\s*(?:MG|ML|G|MCG|UI))', re.IGNORECASE)
+_RE_TIENE_DOSIS = re.compile(r'\d+\s*(?:MG|ML|G|MCG)', re.IGNORECASE)
+# Dosis, vía y frecuencia en un solo patrón: el grupo con nombre indica qué dato coincidió
+_RE_DATOS_MEDICAMENTO = re.compile(
+    r'(?P<dosis>\d+[.,]?\d*\s*(?:MG|ML|G|MCG))'
+    r'|\b(?P<via>VO|IV|SC|IM|ORAL|INTRAVENOSO|SUBCUTANEA)\b'
+    r'|(?P<frecuencia>CADA\s+\d+\s+HORAS|CADA\s+\d+H|CADA\s+\d+\s+DÍAS?|DIARIO|UNA\s+VEZ\s+AL\s+DÍA)',
+    re.IGNORECASE
+)
+
+_RE_PROCEDIMIENTO_QX = re.compile(r'PROCEDIMIENTOS QUIRURGICOS\s*\n\s*(\d+)\s+([^\n]+)', re.IGNORECASE)
+_RE_PROCEDIMIENTO_NO_QX = re.compile(r'ORDENES DE PROCEDIMIENTOS NO QX\s*\n\s*(\d+)\s+([^\n]+)', re.IGNORECASE)
+_RE_FECHA_APLICACION = re.compile(r'Fecha y Hora de Aplicación:(\d{2}/\d{2}/\d{4})\s+(\d{2}:\d{2}:\d{2})')
+
+# Un bloque de cirugía va de 'DESCRIPCION CIRUGIA' al siguiente renglón de 5+ letras
+# (con IGNORECASE, como siempre se ha buscado) o al final del texto
+_RE_INICIO_CIRUGIA = re.compile(r'DESCRIPCION CIRUGIA', re.IGNORECASE)
+_RE_FIN_CIRUGIA = re.compile(r'\n[A-Z]{5,}\n', re.IGNORECASE)
+_RE_DIAGNOSTICO_PRE = re.compile(r'Diagnostico Preoperatorio:\s*([^\n]+)')
+_RE_DIAGNOSTICO_POST = re.compile(r'Diagnostico Postoperatorio:\s*([^\n]+)')
+_RE_ANESTESIA = re.compile(r'Tipo de Anestesia:\s*([^\n]+)')
+_RE_FECHA_CIRUGIA = re.compile(r'Realizacion Acto Quirurgico:\s*(\d{2}/\d{2}/\d{4})')
+_RE_HORA_INICIO = re.compile(r'Hora Inicio\s*(\d{2}:\d{2}:\d{2})')
+_RE_HORA_FINAL = re.compile(r'Hora Final\s*(\d{2}:\d{2}:\d{2})')
+_RE_DESCRIPCION_QX = re.compile(r'Descripcion Quirurgica:\s*')
+_RE_TEJIDOS = re.compile(r'Tejidos enviados a patología\s*:\s*(.*?)(?=\n|$)')
+_RE_PARTICIPANTES = re.compile(r'CÓDIGO\s+([^\n]+)\n\s*([^\n]+)\s+TIPO\s+([^\n]+)\s+PARTICIPO\?\s*([^\n]+)')
+
+_RE_LINEA_ORDEN = re.compile(r'^\s*\d+\s+[A-Za-z]')
+
+_RE_INTERCONSULTA = re.compile(r'INTERCONSULTA POR:\s*([^\n]+)\s+Fecha de Orden:\s*(\d{2}/\d{2}/\d{4})', re.IGNORECASE)
+_RE_EVOLUCION = re.compile(r'EVOLUCION MEDICO\s*\n(.*?)(?=\n[A-Z ]{5,}\n|\Z)', re.DOTALL | re.IGNORECASE)
+_RE_ALTA = re.compile(r'ALTA M[EÉ]DICA.*?(?=\n[A-Z ]{5,}\n|\Z)', re.DOTALL | re.IGNORECASE)
+
+# Segundos de espera sugeridos en los errores de cuota de Gemini
+_RE_RETRY_DELAY = re.compile(r'retry_delay \{ seconds: (\d+) \}')
+
 # ----------------------------------------------------------------------
 # Funciones de utilidad
 # ----------------------------------------------------------------------
 def limpiar_texto(texto):
-    """Elimina líneas vacías múltiples y espacios redundantes."""
-    return re.sub(r'\n\s*\n', '\n', texto.strip())
+    """Elimina caracteres de control, líneas vacías múltiples y espacios redundantes."""
+    return _RE_LINEAS_VACIAS.sub('\n', texto.translate(_TABLA_CONTROL).strip())
 
-def extraer_texto_pdf(archivo_pdf):
-    """Extrae texto de un archivo PDF."""
-    texto = ""
+def extraer_texto_pdf_pypdfium2(archivo_pdf, max_chars=None):
+    """Extrae texto con pypdfium2 (PDFium, motor nativo en C++)."""
+    with _PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(archivo_pdf)
+        try:
+            total_paginas = num_paginas = len(pdf)
+            partes = []
+            total = 0
+            # Las páginas se recorren en serie a propósito: PDFium no es thread-safe,
+            # así que un pool de hilos no es viable (ver _PDFIUM_LOCK).
+            for i in range(num_paginas):
+                pagina = pdf[i]
+                textpage = pagina.get_textpage()
+                texto_pagina = textpage.get_text_range()
+                # Cerrar explícitamente para liberar la memoria nativa de cada página
+                textpage.close()
+                pagina.close()
+                if texto_pagina:
+                    # PDFium separa las líneas con \r\n; los extractores esperan \n
+                    partes.append(texto_pagina.replace('\r\n', '\n'))
+                    total += len(texto_pagina)
+                    if max_chars is not None and total >= max_chars:
+                        # Ya hay suficiente texto; el resto de páginas se descartaría
+                        num_paginas = i + 1
+                        break
+            return "\n".join(partes), num_paginas, total_paginas
+        finally:
+            pdf.close()
+
+def extraer_texto_pdf_pypdf2(archivo_pdf, max_chars=None):
+    """Extrae texto con PyPDF2 (respaldo en Python puro)."""
+    lector = PyPDF2.PdfReader(archivo_pdf)
+    total_paginas = num_paginas = len(lector.pages)
+    partes = []
+    total = 0
+    for i, pagina in enumerate(lector.pages):
+        texto_pagina = pagina.extract_text()
+        if texto_pagina:
+            partes.append(texto_pagina)
+            total += len(texto_pagina)
+            if max_chars is not None and total >= max_chars:
+                num_paginas = i + 1
+                break
+    return "\n".join(partes), num_paginas, total_paginas
+
+def extraer_texto_pdf(archivo_pdf, max_chars=None):
+    """
+    Extrae texto de un archivo PDF (pypdfium2 si está disponible, si no PyPDF2).
+    Si se indica max_chars, deja de leer páginas al alcanzar ese número de caracteres.
+    Devuelve (texto, páginas leídas, páginas totales del documento).
+    """
+    if PDFIUM_AVAILABLE:
+        try:
+            return extraer_texto_pdf_pypdfium2(archivo_pdf, max_chars)
+        except Exception:
+            archivo_pdf.seek(0)
     try:
-        lector = PyPDF2.PdfReader(archivo_pdf)
-        num_paginas = len(lector.pages)
-        for pagina in lector.pages:
-            texto_pagina = pagina.extract_text()
-            if texto_pagina:
-                texto += texto_pagina + "\n"
-        return texto, num_paginas
+        return extraer_texto_pdf_pypdf2(archivo_pdf, max_chars)
     except Exception as e:
         st.error(f"Error al leer el PDF: {e}")
-        return None, 0
+        return None, 0, 0
+
+def hash_archivo_subido(archivo):
+    """
+    SHA-256 del archivo subido, calculado una sola vez por subida (file_id) y no
+    en cada rerun de Streamlit.
+    """
+    guardado = st.session_state.get('hash_subida')
+    if guardado and guardado[0] == archivo.file_id:
+        return guardado[1]
+    digest = generar_hash_archivo(archivo)
+    st.session_state['hash_subida'] = (archivo.file_id, digest)
+    return digest
+
+def generar_hash_archivo(archivo):
+    """Calcula el SHA-256 del archivo subido leyéndolo por bloques."""
+    archivo.seek(0)
+    if hasattr(hashlib, "file_digest"):
+        digest = hashlib.file_digest(archivo, "sha256").hexdigest()
+    else:
+        # hashlib.file_digest solo existe desde Python 3.11
+        sha = hashlib.sha256()
+        for bloque in iter(lambda: archivo.read(1 << 20), b''):
+            sha.update(bloque)
+        digest = sha.hexdigest()
+    archivo.seek(0)
+    return digest
+
+def cache_privada():
+    """
+    Crea la carpeta de caché si no existe e indica si es segura de usar: una carpeta
+    real (no un enlace simbólico), del usuario del proceso y sin permisos para
+    nadie más. Si no lo es, la caché queda desactivada para lectura y escritura,
+    porque otro usuario podría dejar ahí resultados falsos.
+    """
+    try:
+        CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+        info = CACHE_DIR.lstat()
+    except OSError:
+        return False
+    if not stat.S_ISDIR(info.st_mode):
+        return False
+    # En Windows no hay uid ni bits de grupo/otros que revisar
+    if hasattr(os, "getuid") and (info.st_uid != os.getuid() or info.st_mode & 0o077):
+        return False
+    return True
+
+def leer_cache(clave):
+    """Devuelve el contenido guardado en caché para `clave`, o None si no existe o ya venció."""
+    if not cache_privada():
+        return None
+    ruta = CACHE_DIR / f"{clave}.json"
+    try:
+        if time.time() - ruta.stat().st_mtime > CACHE_TTL_SEGUNDOS:
+            ruta.unlink(missing_ok=True)
+            return None
+        return json.loads(ruta.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+def limpiar_cache():
+    """
+    Borra las entradas vencidas (incluidos temporales huérfanos) y, si la caché
+    sigue pasando de CACHE_MAX_BYTES, las más antiguas hasta quedar por debajo.
+    """
+    if not cache_privada():
+        return
+    ahora = time.time()
+    vigentes = []
+    try:
+        rutas = list(CACHE_DIR.iterdir())
+    except OSError:
+        return
+    for ruta in rutas:
+        try:
+            info = ruta.stat()
+            if ahora - info.st_mtime > CACHE_TTL_SEGUNDOS:
+                ruta.unlink(missing_ok=True)
+            elif ruta.suffix == ".json":
+                vigentes.append((info.st_mtime, info.st_size, ruta))
+        except OSError:
+            # Otra sesión pudo borrarla mientras tanto
+            continue
+    total = sum(tamano for _, tamano, _ in vigentes)
+    for _, tamano, ruta in sorted(vigentes):
+        if total <= CACHE_MAX_BYTES:
+            break
+        try:
+            ruta.unlink(missing_ok=True)
+        except OSError:
+            continue
+        total -= tamano
+
+@st.cache_resource(ttl=60 * 60, show_spinner=False)
+def barrer_cache():
+    """
+    Limpia la caché como mucho una vez por hora por proceso, aunque nadie escriba:
+    así los análisis y extracciones vencidos no se quedan en disco esperando una
+    lectura o escritura que quizá no llegue.
+    """
+    limpiar_cache()
+
+def borrar_cache():
+    """Borra todo el contenido de la caché en disco (textos, extracciones y análisis)."""
+    if not cache_privada():
+        return
+    try:
+        rutas = list(CACHE_DIR.iterdir())
+    except OSError:
+        return
+    for ruta in rutas:
+        try:
+            ruta.unlink(missing_ok=True)
+        except OSError:
+            continue
 
-def formatear_fecha(fecha_str):
-    """Convierte fecha DD/MM/AAAA a AAAA-MM-DD para ordenamiento."""
+def guardar_cache(clave, datos):
+    """Guarda `datos` en la caché de forma atómica (archivo temporal + os.replace)."""
+    if not cache_privada():
+        # La caché es opcional: sin una carpeta privada se sigue sin ella
+        return
+    tmp_nombre = None
     try:
-        return datetime.strptime(fecha_str, '%d/%m/%Y').date().isoformat()
-    except:
-        return fecha_str
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=CACHE_DIR, suffix=".tmp", delete=False) as tmp:
+            tmp_nombre = tmp.name
+            json.dump(datos, tmp, ensure_ascii=False, default=str)
+        os.replace(tmp_nombre, CACHE_DIR / f"{clave}.json")
+        tmp_nombre = None
+    except OSError:
+        # La caché es opcional: si no se puede escribir, se sigue sin ella
+        pass
+    finally:
+        # Si algo falló antes del os.replace, no dejar el temporal huérfano
+        if tmp_nombre is not None:
+            try:
+                os.unlink(tmp_nombre)
+            except OSError:
+                pass
+    limpiar_cache()
+
+def extraer_texto_pdf_con_cache(archivo_pdf, hash_archivo, max_chars=None):
+    """Como extraer_texto_pdf, pero reutiliza el texto ya extraído del mismo archivo."""
+    clave = f"{hash_archivo}_texto_{max_chars or 'completo'}"
+    cache = leer_cache(clave)
+    if cache:
+        # Las entradas antiguas no traen el total: se asume que se leyó todo
+        return cache['texto'], cache['num_paginas'], cache.get('total_paginas', cache['num_paginas'])
+    texto, num_paginas, total_paginas = extraer_texto_pdf(archivo_pdf, max_chars)
+    if texto is not None:
+        guardar_cache(clave, {'texto': texto, 'num_paginas': num_paginas, 'total_paginas': total_paginas})
+    return texto, num_paginas, total_paginas
+
+def parece_escaneado(texto, num_paginas):
+    """
+    Indica si el PDF parece escaneado: en promedio trae menos de
+    MIN_LETRAS_POR_PAGINA letras por página, así que no hay nada que extraer.
+    """
+    umbral = max(num_paginas, 1) * MIN_LETRAS_POR_PAGINA
+    if len(texto) < umbral:
+        return True
+    return sum(map(str.isalpha, texto)) < umbral
 
 # ----------------------------------------------------------------------
 # Funciones de extracción mejoradas (completas)
 # ----------------------------------------------------------------------
+def bloques_seccion(texto, marcador, texto_busqueda=None):
+    """
+    Devuelve el contenido que sigue a cada aparición de `marcador` (un literal o un
+    patrón compilado) hasta la siguiente aparición, recortado en el siguiente
+    encabezado de sección. Equivale a split(...)[1:] más el recorte de cada bloque,
+    pero busca sobre el texto completo con str.find y pos/endpos: solo se copia
+    el tramo final de cada bloque, no la historia entera.
+    Si se pasa `texto_busqueda` (p. ej. texto.lower(), con las mismas posiciones),
+    el marcador se busca ahí y los bloques se recortan de `texto`.
+    """
+    if texto_busqueda is None:
+        texto_busqueda = texto
+    if isinstance(marcador, str):
+        tramos = []
+        pos = texto_busqueda.find(marcador)
+        while pos != -1:
+            tramos.append((pos, pos + len(marcador)))
+            pos = texto_busqueda.find(marcador, pos + len(marcador))
+    else:
+        tramos = [match.span() for match in marcador.finditer(texto_busqueda)]
+    bloques = []
+    for n, (_, inicio) in enumerate(tramos):
+        limite = tramos[n + 1][0] if n + 1 < len(tramos) else len(texto)
+        fin = _RE_FIN_BLOQUE.search(texto, inicio, limite)
+        bloques.append(texto[inicio:fin.start() if fin else limite])
+    return bloques
+
 def extraer_paciente(texto):
     """Extrae datos básicos del paciente."""
     paciente = {}
-    doc = re.search(r'CC\s*(\d+)', texto)
+    doc = _RE_DOCUMENTO.search(texto)
     if doc:
         paciente['documento'] = doc.group(1)
-    nombre = re.search(r'--\s*([A-ZÁÉÍÓÚÑ\s]+?)\s+Fec\.\s*Nacimiento', texto)
+    nombre = _RE_NOMBRE.search(texto)
     if nombre:
         paciente['nombre'] = nombre.group(1).strip()
-    fn = re.search(r'Fec\.\s*Nacimiento:\s*(\d{2}/\d{2}/\d{4})', texto)
+    fn = _RE_FECHA_NACIMIENTO.search(texto)
     if fn:
         paciente['fecha_nacimiento'] = fn.group(1)
-    edad = re.search(r'Edad\s*actual:\s*(\d+)\s*AÑOS', texto)
+    edad = _RE_EDAD.search(texto)
     if edad:
         paciente['edad'] = int(edad.group(1))
-    tel = re.search(r'Teléfono:\s*(\d+)', texto)
+    tel = _RE_TELEFONO.search(texto)
     if tel:
         paciente['telefono'] = tel.group(1)
-    dire = re.search(r'Dirección:\s*([^\n]+)', texto)
+    dire = _RE_DIRECCION.search(texto)
     if dire:
         paciente['direccion'] = dire.group(1).strip()
     return paciente
 
-def extraer_servicios(texto):
+def buscar_servicios(texto, texto_min):
+    """
+    Equivale a _RE_SERVICIO.finditer(texto), pero localiza cada 'SEDE DE ATENCION'
+    con str.find sobre la copia en minúsculas y solo ahí intenta el patrón completo
+    (con IGNORECASE el motor de regex no puede saltar directo al literal).
+    """
+    pos = texto_min.find('sede de atencion')
+    while pos != -1:
+        match = _RE_SERVICIO.match(texto, pos)
+        if match:
+            yield match
+            pos = texto_min.find('sede de atencion', match.end())
+        else:
+            pos = texto_min.find('sede de atencion', pos + 1)
+
+def extraer_servicios(texto, texto_min=None):
     """Extrae todos los registros de atención (ingresos a servicios)."""
+    # La copia en minúsculas solo sirve si conserva las posiciones del original
+    if texto_min is not None and len(texto_min) == len(texto):
+        coincidencias = buscar_servicios(texto, texto_min)
+    else:
+        coincidencias = _RE_SERVICIO.finditer(texto)
     servicios = []
-    pattern = r'SEDE DE ATENCION\s+(\d+)\s+([^\n]+?)\s+FOLIO\s+\d+\s+FECHA\s+(\d{2}/\d{2}/\d{4})\s+(\d{2}:\d{2}:\d{2})\s+TIPO DE ATENCION\s*:\s*([^\n]+)'
-    for match in re.finditer(pattern, texto, re.IGNORECASE):
+    for match in coincidencias:
         servicios.append({
             'sede_codigo': match.group(1),
             'sede_nombre': match.group(2).strip(),
@@ -85,20 +449,27 @@ def extraer_servicios(texto):
         })
     return servicios
 
-def extraer_diagnosticos(texto):
-    """Extrae diagnósticos con códigos CIE-10."""
+def extraer_diagnosticos(texto, texto_min=None):
+    """
+    Extrae diagnósticos con códigos CIE-10.
+    `texto_min` es texto.lower(); si se pasa, se evita recalcularlo.
+    """
+    if texto_min is None:
+        texto_min = texto.lower()
+    # Descarte rápido con str.find: sin "diagn" ni "dx" el patrón no puede coincidir
+    if 'diagn' not in texto_min and 'dx' not in texto_min:
+        return []
     diagnosticos = []
-    patron = r'(?:DIAGN[OÓ]STICO|DX|DIAGN[OÓ]STICOS?)\s*:?\s*([A-Z0-9]+\s+[^\n]+)'
-    for match in re.finditer(patron, texto, re.IGNORECASE):
+    for match in _RE_DIAGNOSTICO.finditer(texto):
         diag = match.group(1).strip()
-        codigo = re.search(r'([A-Z]\d{2,3})', diag)
+        codigo = _RE_CODIGO_CIE10.search(diag)
         diagnosticos.append({
             'codigo': codigo.group(1) if codigo else '',
             'descripcion': diag
         })
     return diagnosticos
 
-def extraer_medicamentos(texto):
+def extraer_medicamentos(texto, texto_min=None):
     """
     Extrae medicamentos de:
     - FORMULA MEDICA ESTANDAR
@@ -111,9 +482,9 @@ def extraer_medicamentos(texto):
         partes = linea.strip().split(maxsplit=1)
         if len(partes) < 2:
             return None
-        cantidad = partes[0] if re.match(r'^\d+\.?\d*$', partes[0]) else '1'
+        cantidad = partes[0] if _RE_CANTIDAD.match(partes[0]) else '1'
         desc = partes[1]
-        dosis_match = re.search(r'(\d+[.,]?\d*\s*(?:MG|ML|G|MCG|UI))', desc, re.IGNORECASE)
+        dosis_match = _RE_DOSIS_FORMULA.search(desc)
         dosis = dosis_match.group(1) if dosis_match else ''
         return {
             'cantidad': cantidad,
@@ -124,164 +495,165 @@ def extraer_medicamentos(texto):
             'estado': ''
         }
 
+    def procesar_linea_listado(linea):
+        """Línea de conciliación o plan: una sola pasada llena dosis, vía y frecuencia."""
+        med = {
+            'cantidad': '1',
+            'descripcion': linea,
+            'dosis': '',
+            'frecuencia': '',
+            'via': '',
+            'estado': ''
+        }
+        for match in _RE_DATOS_MEDICAMENTO.finditer(linea):
+            campo = match.lastgroup
+            # Como con búsquedas separadas, se conserva la primera aparición de cada dato
+            if not med[campo]:
+                med[campo] = match.group(campo)
+        return med
+
     # 1. Bloques FORMULA MEDICA ESTANDAR
-    bloques_fm = re.split(r'FORMULA MEDICA ESTANDAR', texto)
-    for bloque in bloques_fm[1:]:
-        fin = re.search(r'\n[A-Z ]{5,}\n', bloque)
-        if fin:
-            bloque = bloque[:fin.start()]
-        lineas = bloque.split('\n')
+    for bloque in bloques_seccion(texto, 'FORMULA MEDICA ESTANDAR'):
+        # Cada línea se limpia una sola vez; abajo se consultan ya sin espacios
+        lineas = [linea.strip() for linea in bloque.split('\n')]
         i = 0
         while i < len(lineas):
-            linea = lineas[i].strip()
+            linea = lineas[i]
             if not linea:
                 i += 1
                 continue
-            if re.match(r'^\s*\d+\.?\d*\s+[A-Za-z0-9]', linea):
+            if _RE_LINEA_MEDICAMENTO.match(linea):
                 med = procesar_linea_med(linea)
                 if med:
                     for j in range(i, min(i+5, len(lineas))):
                         if 'Frecuencia' in lineas[j]:
-                            med['frecuencia'] = lineas[j].strip()
+                            med['frecuencia'] = lineas[j]
                         if 'Via' in lineas[j]:
-                            med['via'] = lineas[j].strip()
+                            med['via'] = lineas[j]
                         if 'Estado:' in lineas[j]:
-                            med['estado'] = lineas[j].strip()
+                            med['estado'] = lineas[j]
                     medicamentos.append(med)
             i += 1
 
+    # Los encabezados sin distinción de mayúsculas se buscan en la copia en minúsculas
+    # (solo si conserva las posiciones del original)
+    if texto_min is not None and len(texto_min) == len(texto):
+        bloques_conc = bloques_seccion(texto, _RE_CONCILIACION_MIN, texto_min)
+        bloques_plan = bloques_seccion(texto, _RE_PLAN_TERAPEUTICO_MIN, texto_min)
+    else:
+        bloques_conc = bloques_seccion(texto, _RE_CONCILIACION)
+        bloques_plan = bloques_seccion(texto, _RE_PLAN_TERAPEUTICO)
+
     # 2. Bloques CONCILIACIÓN MEDICAMENTOSA
-    bloques_conc = re.split(r'CONCILIACI[OÓ]N MEDICAMENTOSA', texto, re.IGNORECASE)
-    for bloque in bloques_conc[1:]:
-        fin = re.search(r'\n[A-Z ]{5,}\n', bloque)
-        if fin:
-            bloque = bloque[:fin.start()]
+    for bloque in bloques_conc:
         lineas = bloque.split('\n')
         for linea in lineas:
             linea = linea.strip()
             if not linea:
                 continue
-            if re.search(r'\d+\s*(?:MG|ML|G|MCG)', linea, re.IGNORECASE):
-                med = {
-                    'cantidad': '1',
-                    'descripcion': linea,
-                    'dosis': '',
-                    'frecuencia': '',
-                    'via': '',
-                    'estado': ''
-                }
-                dosis_match = re.search(r'(\d+[.,]?\d*\s*(?:MG|ML|G|MCG))', linea, re.IGNORECASE)
-                if dosis_match:
-                    med['dosis'] = dosis_match.group(1)
-                via_match = re.search(r'\b(VO|IV|SC|IM|ORAL|INTRAVENOSO|SUBCUTANEA)\b', linea, re.IGNORECASE)
-                if via_match:
-                    med['via'] = via_match.group(1)
-                freq_match = re.search(r'(CADA\s+\d+\s+HORAS|CADA\s+\d+H|CADA\s+\d+\s+DÍAS?|DIARIO|UNA\s+VEZ\s+AL\s+DÍA)', linea, re.IGNORECASE)
-                if freq_match:
-                    med['frecuencia'] = freq_match.group(1)
-                medicamentos.append(med)
+            if _RE_TIENE_DOSIS.search(linea):
+                medicamentos.append(procesar_linea_listado(linea))
 
     # 3. PLAN - TERAPEUTICO (líneas con guiones)
-    bloques_plan = re.split(r'PLAN\s*[-:]?\s*TERAPEUTICO', texto, re.IGNORECASE)
-    for bloque in bloques_plan[1:]:
-        fin = re.search(r'\n[A-Z ]{5,}\n', bloque)
-        if fin:
-            bloque = bloque[:fin.start()]
+    for bloque in bloques_plan:
         lineas = bloque.split('\n')
         for linea in lineas:
             linea = linea.strip()
             if not linea or not linea.startswith('-'):
                 continue
             linea = linea[1:].strip()
-            if re.search(r'\d+\s*(?:MG|ML|G|MCG)', linea, re.IGNORECASE):
-                med = {
-                    'cantidad': '1',
-                    'descripcion': linea,
-                    'dosis': '',
-                    'frecuencia': '',
-                    'via': '',
-                    'estado': ''
-                }
-                dosis_match = re.search(r'(\d+[.,]?\d*\s*(?:MG|ML|G|MCG))', linea, re.IGNORECASE)
-                if dosis_match:
-                    med['dosis'] = dosis_match.group(1)
-                via_match = re.search(r'\b(VO|IV|SC|IM|ORAL|INTRAVENOSO|SUBCUTANEA)\b', linea, re.IGNORECASE)
-                if via_match:
-                    med['via'] = via_match.group(1)
-                freq_match = re.search(r'(CADA\s+\d+\s+HORAS|CADA\s+\d+H|CADA\s+\d+\s+DÍAS?|DIARIO|UNA\s+VEZ\s+AL\s+DÍA)', linea, re.IGNORECASE)
-                if freq_match:
-                    med['frecuencia'] = freq_match.group(1)
-                medicamentos.append(med)
+            if _RE_TIENE_DOSIS.search(linea):
+                medicamentos.append(procesar_linea_listado(linea))
 
     return medicamentos
 
 def extraer_procedimientos(texto):
     """Extrae procedimientos quirúrgicos y no quirúrgicos con fechas."""
     procedimientos = []
-
-    pattern_qx = r'PROCEDIMIENTOS QUIRURGICOS\s*\n\s*(\d+)\s+([^\n]+)'
-    for match in re.finditer(pattern_qx, texto, re.IGNORECASE):
+    # Posición de cada descripción en el texto, para buscar su fecha alrededor
+    posiciones = []
+    for match in _RE_PROCEDIMIENTO_QX.finditer(texto):
         procedimientos.append({
             'tipo': 'quirurgico',
             'cantidad': match.group(1).strip(),
             'descripcion': match.group(2).strip(),
             'fecha': None
         })
+        posiciones.append(match.start(2))
 
-    pattern_noqx = r'ORDENES DE PROCEDIMIENTOS NO QX\s*\n\s*(\d+)\s+([^\n]+)'
-    for match in re.finditer(pattern_noqx, texto, re.IGNORECASE):
+    for match in _RE_PROCEDIMIENTO_NO_QX.finditer(texto):
         procedimientos.append({
             'tipo': 'no_quirurgico',
             'cantidad': match.group(1).strip(),
             'descripcion': match.group(2).strip(),
             'fecha': None
         })
+        posiciones.append(match.start(2))
 
-    for proc in procedimientos:
-        desc = proc['descripcion']
-        idx = texto.find(desc)
-        if idx != -1:
-            ventana = texto[max(0, idx-200):idx+200]
-            fecha_match = re.search(r'Fecha y Hora de Aplicación:(\d{2}/\d{2}/\d{4})\s+(\d{2}:\d{2}:\d{2})', ventana)
-            if fecha_match:
-                proc['fecha'] = fecha_match.group(1)
-                proc['hora'] = fecha_match.group(2)
+    for proc, idx in zip(procedimientos, posiciones):
+        # Ventana de ±200 caracteres sin recortar el texto (pos/endpos)
+        fecha_match = _RE_FECHA_APLICACION.search(texto, max(0, idx-200), idx+200)
+        if fecha_match:
+            proc['fecha'] = fecha_match.group(1)
+            proc['hora'] = fecha_match.group(2)
 
     return procedimientos
 
-def extraer_cirugias(texto):
+def bloques_cirugia(texto, texto_min=None):
+    """
+    Devuelve cada bloque 'DESCRIPCION CIRUGIA' hasta el siguiente encabezado o el
+    final del texto. Los límites se buscan directamente (str.find sobre la copia en
+    minúsculas si está disponible) en vez de avanzar con un .*? perezoso.
+    """
+    usar_min = texto_min is not None and len(texto_min) == len(texto)
+    pos = 0
+    while True:
+        if usar_min:
+            inicio = texto_min.find('descripcion cirugia', pos)
+        else:
+            match = _RE_INICIO_CIRUGIA.search(texto, pos)
+            inicio = match.start() if match else -1
+        if inicio == -1:
+            return
+        fin = _RE_FIN_CIRUGIA.search(texto, inicio + len('descripcion cirugia'))
+        pos = fin.start() if fin else len(texto)
+        yield texto[inicio:pos]
+
+def extraer_cirugias(texto, texto_min=None):
     """Extrae información detallada de cirugías (descripciones, participantes, etc.)"""
     cirugias = []
-    patron = r'DESCRIPCION CIRUGIA.*?(?=\n[A-Z]{5,}\n|\Z)'
-    for bloque in re.finditer(patron, texto, re.DOTALL | re.IGNORECASE):
-        bloque_texto = bloque.group(0)
+    for bloque_texto in bloques_cirugia(texto, texto_min):
         cirugia = {}
 
-        pre = re.search(r'Diagnostico Preoperatorio:\s*([^\n]+)', bloque_texto)
+        pre = _RE_DIAGNOSTICO_PRE.search(bloque_texto)
         if pre:
             cirugia['diagnostico_pre'] = pre.group(1).strip()
-        post = re.search(r'Diagnostico Postoperatorio:\s*([^\n]+)', bloque_texto)
+        post = _RE_DIAGNOSTICO_POST.search(bloque_texto)
         if post:
             cirugia['diagnostico_post'] = post.group(1).strip()
-        anest = re.search(r'Tipo de Anestesia:\s*([^\n]+)', bloque_texto)
+        anest = _RE_ANESTESIA.search(bloque_texto)
         if anest:
             cirugia['anestesia'] = anest.group(1).strip()
-        fecha = re.search(r'Realizacion Acto Quirurgico:\s*(\d{2}/\d{2}/\d{4})', bloque_texto)
+        fecha = _RE_FECHA_CIRUGIA.search(bloque_texto)
         if fecha:
             cirugia['fecha'] = fecha.group(1)
-        hora_inicio = re.search(r'Hora Inicio\s*(\d{2}:\d{2}:\d{2})', bloque_texto)
+        hora_inicio = _RE_HORA_INICIO.search(bloque_texto)
         if hora_inicio:
             cirugia['hora_inicio'] = hora_inicio.group(1)
-        hora_fin = re.search(r'Hora Final\s*(\d{2}:\d{2}:\d{2})', bloque_texto)
+        hora_fin = _RE_HORA_FINAL.search(bloque_texto)
         if hora_fin:
             cirugia['hora_fin'] = hora_fin.group(1)
-        desc = re.search(r'Descripcion Quirurgica:\s*(.*?)(?=\nComplicacion:|\Z)', bloque_texto, re.DOTALL)
+        desc = _RE_DESCRIPCION_QX.search(bloque_texto)
         if desc:
-            cirugia['descripcion'] = desc.group(1).strip().replace('\n', ' ')
-        tej = re.search(r'Tejidos enviados a patología\s*:\s*(.*?)(?=\n|$)', bloque_texto)
+            # La descripción termina en la línea 'Complicacion:' o al final del bloque
+            fin = bloque_texto.find('\nComplicacion:', desc.end())
+            if fin == -1:
+                fin = len(bloque_texto)
+            cirugia['descripcion'] = bloque_texto[desc.end():fin].strip().replace('\n', ' ')
+        tej = _RE_TEJIDOS.search(bloque_texto)
         if tej:
             cirugia['tejidos_patologia'] = tej.group(1).strip()
-        participantes = re.findall(r'CÓDIGO\s+([^\n]+)\n\s*([^\n]+)\s+TIPO\s+([^\n]+)\s+PARTICIPO\?\s*([^\n]+)', bloque_texto)
+        participantes = _RE_PARTICIPANTES.findall(bloque_texto)
         if participantes:
             cirugia['participantes'] = [{'codigo': p[0], 'nombre': p[1], 'tipo': p[2], 'participo': p[3]} for p in participantes]
 
@@ -293,19 +665,16 @@ def extraer_cirugias(texto):
 def extraer_laboratorios(texto):
     """Extrae órdenes de laboratorio y resultados."""
     laboratorios = []
-    bloques = re.split(r'ORDENES DE LABORATORIO', texto)
-    for bloque in bloques[1:]:
-        fin = re.search(r'\n[A-Z ]{5,}\n', bloque)
-        if fin:
-            bloque = bloque[:fin.start()]
-        lineas = bloque.split('\n')
+    for bloque in bloques_seccion(texto, 'ORDENES DE LABORATORIO'):
+        # Cada línea se limpia una sola vez; abajo se consultan ya sin espacios
+        lineas = [linea.strip() for linea in bloque.split('\n')]
         i = 0
         while i < len(lineas):
-            linea = lineas[i].strip()
+            linea = lineas[i]
             if not linea:
                 i += 1
                 continue
-            if re.match(r'^\s*\d+\s+[A-Za-z]', linea):
+            if _RE_LINEA_ORDEN.match(linea):
                 partes = linea.split(maxsplit=1)
                 if len(partes) == 2:
                     lab = {
@@ -316,17 +685,16 @@ def extraer_laboratorios(texto):
                     }
                     for j in range(i, min(i+5, len(lineas))):
                         if 'Fecha y Hora de Aplicación' in lineas[j]:
-                            fecha_match = re.search(r'(\d{2}/\d{2}/\d{4})\s+(\d{2}:\d{2}:\d{2})', lineas[j])
+                            fecha_match = _RE_FECHA_HORA.search(lineas[j])
                             if fecha_match:
                                 lab['fecha'] = fecha_match.group(1)
                                 lab['hora'] = fecha_match.group(2)
                         if 'Resultados:' in lineas[j]:
                             k = j+1
                             resultados = []
-                            while k < len(lineas) and not re.match(r'^\s*\d+\s+[A-Za-z]', lineas[k]) and not re.match(r'\n[A-Z ]{5,}\n', lineas[k]):
-                                res_linea = lineas[k].strip()
-                                if res_linea:
-                                    resultados.append(res_linea)
+                            while k < len(lineas) and not _RE_LINEA_ORDEN.match(lineas[k]):
+                                if lineas[k]:
+                                    resultados.append(lineas[k])
                                 k += 1
                             if resultados:
                                 lab['resultado'] = ' '.join(resultados)
@@ -338,19 +706,16 @@ def extraer_laboratorios(texto):
 def extraer_imagenes(texto):
     """Extrae órdenes de imágenes diagnósticas y sus informes."""
     imagenes = []
-    bloques = re.split(r'ORDENES DE IMAGENES DIAGNOSTICAS', texto)
-    for bloque in bloques[1:]:
-        fin = re.search(r'\n[A-Z ]{5,}\n', bloque)
-        if fin:
-            bloque = bloque[:fin.start()]
-        lineas = bloque.split('\n')
+    for bloque in bloques_seccion(texto, 'ORDENES DE IMAGENES DIAGNOSTICAS'):
+        # Cada línea se limpia una sola vez; abajo se consultan ya sin espacios
+        lineas = [linea.strip() for linea in bloque.split('\n')]
         i = 0
         while i < len(lineas):
-            linea = lineas[i].strip()
+            linea = lineas[i]
             if not linea:
                 i += 1
                 continue
-            if re.match(r'^\s*\d+\s+[A-Za-z]', linea):
+            if _RE_LINEA_ORDEN.match(linea):
                 partes = linea.split(maxsplit=1)
                 if len(partes) == 2:
                     img = {
@@ -361,17 +726,16 @@ def extraer_imagenes(texto):
                     }
                     for j in range(i, min(i+5, len(lineas))):
                         if 'Fecha y Hora de Aplicación' in lineas[j]:
-                            fecha_match = re.search(r'(\d{2}/\d{2}/\d{4})\s+(\d{2}:\d{2}:\d{2})', lineas[j])
+                            fecha_match = _RE_FECHA_HORA.search(lineas[j])
                             if fecha_match:
                                 img['fecha'] = fecha_match.group(1)
                                 img['hora'] = fecha_match.group(2)
                         if 'Resultados:' in lineas[j]:
                             k = j+1
                             resultados = []
-                            while k < len(lineas) and not re.match(r'^\s*\d+\s+[A-Za-z]', lineas[k]) and not re.match(r'\n[A-Z ]{5,}\n', lineas[k]):
-                                res_linea = lineas[k].strip()
-                                if res_linea:
-                                    resultados.append(res_linea)
+                            while k < len(lineas) and not _RE_LINEA_ORDEN.match(lineas[k]):
+                                if lineas[k]:
+                                    resultados.append(lineas[k])
                                 k += 1
                             if resultados:
                                 img['resultado'] = ' '.join(resultados)
@@ -383,8 +747,7 @@ def extraer_imagenes(texto):
 def extraer_interconsultas(texto):
     """Extrae solicitudes de interconsulta."""
     interconsultas = []
-    patron = r'INTERCONSULTA POR:\s*([^\n]+)\s+Fecha de Orden:\s*(\d{2}/\d{2}/\d{4})'
-    for match in re.finditer(patron, texto, re.IGNORECASE):
+    for match in _RE_INTERCONSULTA.finditer(texto):
         interconsultas.append({
             'especialidad': match.group(1).strip(),
             'fecha_orden': match.group(2).strip()
@@ -394,10 +757,9 @@ def extraer_interconsultas(texto):
 def extraer_evoluciones(texto):
     """Extrae notas de evolución (fecha, médico, texto)"""
     evoluciones = []
-    patron = r'EVOLUCION MEDICO\s*\n(.*?)(?=\n[A-Z ]{5,}\n|\Z)'
-    for match in re.finditer(patron, texto, re.DOTALL | re.IGNORECASE):
+    for match in _RE_EVOLUCION.finditer(texto):
         bloque = match.group(1).strip()
-        fecha = re.search(r'(\d{2}/\d{2}/\d{4})', bloque)
+        fecha = _RE_FECHA.search(bloque)
         evoluciones.append({
             'fecha': fecha.group(1) if fecha else None,
             'texto': bloque
@@ -407,10 +769,9 @@ def extraer_evoluciones(texto):
 def extraer_altas(texto):
     """Extrae información de alta médica."""
     altas = []
-    patron = r'ALTA M[EÉ]DICA.*?(?=\n[A-Z ]{5,}\n|\Z)'
-    for match in re.finditer(patron, texto, re.DOTALL | re.IGNORECASE):
+    for match in _RE_ALTA.finditer(texto):
         bloque = match.group(0)
-        fecha = re.search(r'(\d{2}/\d{2}/\d{4})', bloque)
+        fecha = _RE_FECHA.search(bloque)
         altas.append({
             'fecha': fecha.group(1) if fecha else None,
             'info': bloque
@@ -420,143 +781,275 @@ def extraer_altas(texto):
 # ----------------------------------------------------------------------
 # Extracción mediante IA con Gemini
 # ----------------------------------------------------------------------
+def cargar_gemini():
+    """
+    Importa google-generativeai y sus excepciones la primera vez que se necesitan;
+    las llamadas siguientes salen directo de sys.modules.
+    """
+    import google.generativeai as genai
+    from google.api_core import exceptions
+    return genai, exceptions
+
+# genai.configure cambia la API key de todo el proceso y las sesiones de Streamlit
+# corren en hilos distintos: configurar y crear el cliente va siempre bajo este candado
+_GEMINI_LOCK = threading.Lock()
+
 def configure_gemini(api_key):
+    genai, _ = cargar_gemini()
     genai.configure(api_key=api_key)
 
-def extract_with_gemini(text, api_key, model_name="gemini-2.0-flash", max_chars=200000):
+@st.cache_resource(show_spinner=False)
+def obtener_modelo(api_key, model_name):
+    """
+    Devuelve el GenerativeModel de esta API key; se reutiliza entre reruns de Streamlit.
+    El modelo queda atado desde ya a un cliente creado con su propia key: si no, lo
+    tomaría en la primera llamada de la configuración global, que puede ser la key
+    de otra sesión.
+    Depende de un atributo interno del SDK (`_client`, revisado en 0.5.0–0.8.6, ver
+    requirements.txt): si cambia, se falla con error en vez de volver en silencio
+    a la configuración global.
+    """
+    genai, _ = cargar_gemini()
+    from google.generativeai import client as cliente_genai
+    with _GEMINI_LOCK:
+        configure_gemini(api_key)
+        modelo = genai.GenerativeModel(model_name)
+        # Un modelo recién creado trae _client en None y lo llena en la primera llamada
+        if getattr(modelo, '_client', False) is not None:
+            raise RuntimeError(
+                "Esta versión de google-generativeai no es compatible: no se puede atar "
+                "el modelo a la API key de la sesión. Instala google-generativeai<0.9."
+            )
+        cliente = cliente_genai.get_default_generative_client()
+        modelo._client = cliente
+        if getattr(modelo, '_client', None) is not cliente:
+            raise RuntimeError(
+                "Esta versión de google-generativeai no es compatible: el modelo no "
+                "conservó el cliente de la sesión. Instala google-generativeai<0.9."
+            )
+    return modelo
+
+def extraer_json_respuesta(contenido):
+    """
+    Decodifica el JSON de una respuesta de Gemini. Con CONFIG_EXTRACCION la respuesta
+    ya es JSON puro; si no lo es (p. ej. viene dentro de un bloque ```json ... ``` en
+    modelos sin modo JSON), toma desde la primera llave hasta la última '}' antes del
+    último cierre de bloque, así un ``` dentro de un valor de texto no corta el JSON.
+    """
+    try:
+        return orjson.loads(contenido)
+    except orjson.JSONDecodeError:
+        pass
+    llave = contenido.find('{')
+    if llave == -1:
+        return orjson.loads(contenido)
+    cierre = contenido.rfind('```')
+    if cierre <= llave:
+        cierre = len(contenido)
+    fin = contenido.rfind('}', llave, cierre)
+    return orjson.loads(contenido[llave:fin + 1])
+
+# Salida JSON nativa de Gemini y sin aleatoriedad: la extracción debe ser reproducible
+CONFIG_EXTRACCION = {"response_mime_type": "application/json", "temperature": 0.0}
+
+PROMPT_EXTRACCION = """\
+Eres un asistente experto en análisis de historias clínicas. A partir del siguiente texto, extrae toda la información relevante y devuélvela en formato JSON con la siguiente estructura:
+
+{
+    "paciente": {
+        "documento": "string",
+        "nombre": "string",
+        "fecha_nacimiento": "string (DD/MM/AAAA)",
+        "edad": número,
+        "telefono": "string",
+        "direccion": "string"
+    },
+    "servicios": [
+        {
+            "sede_codigo": "string",
+            "sede_nombre": "string",
+            "fecha": "string (DD/MM/AAAA)",
+            "hora": "string (HH:MM:SS)",
+            "tipo_atencion": "string"
+        }
+    ],
+    "diagnosticos": [
+        {
+            "codigo": "string (CIE-10)",
+            "descripcion": "string"
+        }
+    ],
+    "medicamentos": [
+        {
+            "cantidad": "string",
+            "descripcion": "string",
+            "dosis": "string",
+            "frecuencia": "string",
+            "via": "string",
+            "estado": "string"
+        }
+    ],
+    "procedimientos": [
+        {
+            "tipo": "quirurgico/no_quirurgico",
+            "cantidad": "string",
+            "descripcion": "string",
+            "fecha": "string (opcional)",
+            "hora": "string (opcional)"
+        }
+    ],
+    "cirugias": [
+        {
+            "diagnostico_pre": "string",
+            "diagnostico_post": "string",
+            "anestesia": "string",
+            "fecha": "string",
+            "hora_inicio": "string",
+            "hora_fin": "string",
+            "descripcion": "string",
+            "tejidos_patologia": "string",
+            "participantes": [
+                {
+                    "codigo": "string",
+                    "nombre": "string",
+                    "tipo": "string",
+                    "participo": "string"
+                }
+            ]
+        }
+    ],
+    "laboratorios": [
+        {
+            "cantidad": "string",
+            "descripcion": "string",
+            "fecha": "string",
+            "resultado": "string"
+        }
+    ],
+    "imagenes": [
+        {
+            "cantidad": "string",
+            "descripcion": "string",
+            "fecha": "string",
+            "resultado": "string"
+        }
+    ],
+    "interconsultas": [
+        {
+            "especialidad": "string",
+            "fecha_orden": "string"
+        }
+    ],
+    "evoluciones": [
+        {
+            "fecha": "string",
+            "texto": "string"
+        }
+    ],
+    "altas": [
+        {
+            "fecha": "string",
+            "info": "string"
+        }
+    ]
+}
+
+Si algún campo no se encuentra, déjalo vacío (null, lista vacía o string vacío según corresponda). Responde únicamente con el JSON, sin texto adicional.
+
+Texto de la historia clínica:
+"""
+
+# Versión de la extracción por IA: cambia sola si se edita el prompt, la configuración
+# o el tamaño de fragmento, e invalida así los resultados guardados en caché
+VERSION_EXTRACCION_IA = hashlib.sha256(
+    f"{PROMPT_EXTRACCION}{CONFIG_EXTRACCION}{TAMANO_FRAGMENTO_IA}".encode()
+).hexdigest()[:12]
+
+def dividir_texto_ia(texto, tamano=TAMANO_FRAGMENTO_IA):
+    """
+    Parte el texto en fragmentos de hasta `tamano` caracteres, sin solaparse.
+    Se corta preferiblemente al inicio de una atención ('SEDE DE ATENCION') y,
+    si no hay ninguna en la segunda mitad del fragmento, en un salto de línea.
+    """
+    fragmentos = []
+    inicio = 0
+    while len(texto) - inicio > tamano:
+        limite = inicio + tamano
+        mitad = inicio + tamano // 2
+        corte = texto.rfind('SEDE DE ATENCION', mitad, limite)
+        if corte == -1:
+            corte = texto.rfind('\n', mitad, limite)
+        if corte == -1:
+            corte = limite
+        fragmentos.append(texto[inicio:corte])
+        inicio = corte
+    fragmentos.append(texto[inicio:])
+    return fragmentos
+
+def combinar_extracciones(partes):
+    """
+    Une los JSON de varios fragmentos: las listas se concatenan en orden y en
+    'paciente' cada campo se toma del primer fragmento que lo trae.
+    """
+    resultado = {}
+    for parte in partes:
+        for clave, valor in parte.items():
+            if isinstance(valor, list):
+                resultado.setdefault(clave, []).extend(valor)
+            elif isinstance(valor, dict):
+                destino = resultado.setdefault(clave, {})
+                for campo, dato in valor.items():
+                    if dato and not destino.get(campo):
+                        destino[campo] = dato
+    return resultado
+
+def extract_with_gemini(text, api_key, model_name="gemini-2.0-flash", max_chars=MAX_CARACTERES_IA):
     """
     Envía el texto a Gemini y pide que devuelva un JSON estructurado.
+    Las historias largas se parten en fragmentos que se consultan en paralelo
+    y luego se combinan en un solo resultado.
     """
-    configure_gemini(api_key)
-    model = genai.GenerativeModel(model_name)
+    _, exceptions = cargar_gemini()
     
     if len(text) > max_chars:
         text = text[:max_chars]
         st.warning(f"El texto es muy largo, se truncó a {max_chars} caracteres para la extracción por IA.")
     
-    prompt = f"""
-    Eres un asistente experto en análisis de historias clínicas. A partir del siguiente texto, extrae toda la información relevante y devuélvela en formato JSON con la siguiente estructura:
-    
-    {{
-        "paciente": {{
-            "documento": "string",
-            "nombre": "string",
-            "fecha_nacimiento": "string (DD/MM/AAAA)",
-            "edad": número,
-            "telefono": "string",
-            "direccion": "string"
-        }},
-        "servicios": [
-            {{
-                "sede_codigo": "string",
-                "sede_nombre": "string",
-                "fecha": "string (DD/MM/AAAA)",
-                "hora": "string (HH:MM:SS)",
-                "tipo_atencion": "string"
-            }}
-        ],
-        "diagnosticos": [
-            {{
-                "codigo": "string (CIE-10)",
-                "descripcion": "string"
-            }}
-        ],
-        "medicamentos": [
-            {{
-                "cantidad": "string",
-                "descripcion": "string",
-                "dosis": "string",
-                "frecuencia": "string",
-                "via": "string",
-                "estado": "string"
-            }}
-        ],
-        "procedimientos": [
-            {{
-                "tipo": "quirurgico/no_quirurgico",
-                "cantidad": "string",
-                "descripcion": "string",
-                "fecha": "string (opcional)",
-                "hora": "string (opcional)"
-            }}
-        ],
-        "cirugias": [
-            {{
-                "diagnostico_pre": "string",
-                "diagnostico_post": "string",
-                "anestesia": "string",
-                "fecha": "string",
-                "hora_inicio": "string",
-                "hora_fin": "string",
-                "descripcion": "string",
-                "tejidos_patologia": "string",
-                "participantes": [
-                    {{
-                        "codigo": "string",
-                        "nombre": "string",
-                        "tipo": "string",
-                        "participo": "string"
-                    }}
-                ]
-            }}
-        ],
-        "laboratorios": [
-            {{
-                "cantidad": "string",
-                "descripcion": "string",
-                "fecha": "string",
-                "resultado": "string"
-            }}
-        ],
-        "imagenes": [
-            {{
-                "cantidad": "string",
-                "descripcion": "string",
-                "fecha": "string",
-                "resultado": "string"
-            }}
-        ],
-        "interconsultas": [
-            {{
-                "especialidad": "string",
-                "fecha_orden": "string"
-            }}
-        ],
-        "evoluciones": [
-            {{
-                "fecha": "string",
-                "texto": "string"
-            }}
-        ],
-        "altas": [
-            {{
-                "fecha": "string",
-                "info": "string"
-            }}
-        ]
-    }}
-    
-    Si algún campo no se encuentra, déjalo vacío (null, lista vacía o string vacío según corresponda). Responde únicamente con el JSON, sin texto adicional.
-    
-    Texto de la historia clínica:
-    {text}
-    """
-    
+    fragmentos = dividir_texto_ia(text)
+    content = ""
     try:
-        response = model.generate_content(prompt)
-        content = response.text
-        json_match = re.search(r'```json\s*(\{.*?\})\s*```', content, re.DOTALL)
-        if json_match:
-            content = json_match.group(1)
-        data = json.loads(content)
-        return data
+        model = obtener_modelo(api_key, model_name)
+        # Los hilos solo hacen la llamada de red (nada de st.* dentro); el texto
+        # va como una parte aparte para no copiarlo dentro de un prompt gigante
+        with ThreadPoolExecutor(max_workers=min(MAX_LLAMADAS_IA_PARALELAS, len(fragmentos))) as ejecutor:
+            futuros = [
+                ejecutor.submit(
+                    lambda fragmento: model.generate_content(
+                        [PROMPT_EXTRACCION, fragmento], generation_config=CONFIG_EXTRACCION
+                    ).text,
+                    fragmento
+                )
+                for fragmento in fragmentos
+            ]
+            # Avance visible a medida que termina cada fragmento (la barra se actualiza
+            # desde el hilo principal)
+            if len(futuros) > 1:
+                barra = st.progress(0.0, text=f"Fragmentos procesados: 0/{len(futuros)}")
+                for hechos, _ in enumerate(as_completed(futuros), 1):
+                    barra.progress(hechos / len(futuros), text=f"Fragmentos procesados: {hechos}/{len(futuros)}")
+                barra.empty()
+            respuestas = [futuro.result() for futuro in futuros]
+        partes = []
+        for content in respuestas:
+            partes.append(extraer_json_respuesta(content))
+        return partes[0] if len(partes) == 1 else combinar_extracciones(partes)
     except json.JSONDecodeError:
         st.error("La respuesta de Gemini no es un JSON válido. Mostrando respuesta cruda:")
         st.code(content)
         return None
     except exceptions.ResourceExhausted as e:
         st.error(f"Límite de cuota excedido: {e}")
-        retry_match = re.search(r'retry_delay \{ seconds: (\d+) \}', str(e))
+        retry_match = _RE_RETRY_DELAY.search(str(e))
         if retry_match:
             seconds = int(retry_match.group(1))
             st.info(f"Por favor, espera {seconds} segundos antes de reintentar.")
@@ -568,24 +1061,133 @@ def extract_with_gemini(text, api_key, model_name="gemini-2.0-flash", max_chars=
 # ----------------------------------------------------------------------
 # Función para análisis con IA (genérico)
 # ----------------------------------------------------------------------
+# Encabezados fijos que preceden a los datos en el prompt de análisis
+ENCABEZADO_DATOS_JSON = "\n\nDatos extraídos de la historia clínica (formato JSON):\n"
+ENCABEZADO_TEXTO_COMPLETO = "\n\nTexto completo de la historia clínica:\n"
+ENCABEZADO_RESUMENES = "\n\nResúmenes parciales de la historia clínica, en orden cronológico:\n"
+
+PROMPT_RESUMEN_PARCIAL = """\
+Eres un asistente médico. El siguiente texto es un fragmento de una historia clínica más larga.
+Resume de forma concisa y fiel todo lo clínicamente relevante del fragmento: datos del paciente,
+servicios y fechas, diagnósticos con su código, medicamentos (dosis, vía, frecuencia),
+procedimientos, cirugías, laboratorios, imágenes, interconsultas, evolución y altas.
+Conserva fechas, códigos y valores exactos. No inventes información ni agregues conclusiones.
+"""
+
+def resumir_fragmentos(texto, model, model_name, max_chars=MAX_CARACTERES_IA):
+    """
+    Resume en paralelo cada fragmento del texto (fase "map" del análisis de
+    historias largas). Devuelve los resúmenes en el orden original y si están todos.
+    Cada resumen se guarda en caché al llegar, así que un fallo no obliga a pagar
+    de nuevo los fragmentos que sí se resumieron; los que fallan quedan marcados.
+    """
+    if len(texto) > max_chars:
+        texto = texto[:max_chars]
+        st.warning(f"El texto es muy largo, se truncó a {max_chars} caracteres para el análisis por IA.")
+
+    fragmentos = dividir_texto_ia(texto)
+    resumenes = [None] * len(fragmentos)
+    claves = []
+    for i, fragmento in enumerate(fragmentos):
+        digest = hashlib.sha256(f"{model_name}\n{PROMPT_RESUMEN_PARCIAL}\n".encode())
+        digest.update(fragmento.encode())
+        claves.append("resumen_" + digest.hexdigest())
+        cache = leer_cache(claves[i])
+        if cache:
+            resumenes[i] = cache['texto']
+    pendientes = [i for i, resumen in enumerate(resumenes) if resumen is None]
+
+    errores = []
+    if pendientes:
+        # Igual que en la extracción, los hilos solo hacen la llamada de red (nada de st.*)
+        with ThreadPoolExecutor(max_workers=min(MAX_LLAMADAS_IA_PARALELAS, len(pendientes))) as ejecutor:
+            futuros = {
+                ejecutor.submit(
+                    lambda fragmento: model.generate_content(
+                        [PROMPT_RESUMEN_PARCIAL, fragmento], generation_config={"temperature": 0.0}
+                    ).text,
+                    fragmentos[i]
+                ): i
+                for i in pendientes
+            }
+            barra = None
+            if len(futuros) > 1:
+                barra = st.progress(0.0, text=f"Fragmentos resumidos: 0/{len(futuros)}")
+            for hechos, futuro in enumerate(as_completed(futuros), 1):
+                i = futuros[futuro]
+                try:
+                    resumenes[i] = futuro.result()
+                    guardar_cache(claves[i], {'texto': resumenes[i]})
+                except Exception as e:
+                    errores.append(e)
+                if barra is not None:
+                    barra.progress(hechos / len(futuros), text=f"Fragmentos resumidos: {hechos}/{len(futuros)}")
+            if barra is not None:
+                barra.empty()
+
+    if errores:
+        if all(resumen is None for resumen in resumenes):
+            # Sin ningún resumen no hay nada que analizar: se informa el primer error
+            raise errores[0]
+        st.warning(
+            f"No se pudieron resumir {len(errores)} de {len(fragmentos)} fragmentos ({errores[0]}). "
+            "El análisis se hace con el resto y no se guarda en caché."
+        )
+    return [
+        resumen if resumen is not None else f"[Fragmento {i + 1}: resumen no disponible]"
+        for i, resumen in enumerate(resumenes)
+    ], not errores
+
 def analyze_with_gemini(data, prompt, api_key, model_name, data_format="json"):
-    """Envía datos a Gemini y retorna la respuesta textual."""
-    configure_gemini(api_key)
-    model = genai.GenerativeModel(model_name)
+    """
+    Envía datos a Gemini y va entregando la respuesta por trozos a medida que llega
+    (generador, pensado para st.write_stream). La respuesta completa se guarda en
+    la caché en disco, indexada por el modelo y el prompt completo.
+    Si el texto completo supera MAX_CARACTERES_ANALISIS, se resume por fragmentos
+    (hasta MAX_CARACTERES_IA) y el prompt del usuario se aplica sobre los resúmenes.
+    """
     if data_format == "json":
-        data_str = json.dumps(data, indent=2, ensure_ascii=False, default=str)
-        full_prompt = f"{prompt}\n\nDatos extraídos de la historia clínica (formato JSON):\n{data_str}"
+        partes = [
+            prompt,
+            ENCABEZADO_DATOS_JSON,
+            orjson.dumps(data, default=str, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
+        ]
     else:
-        # Texto completo truncado
-        full_prompt = f"{prompt}\n\nTexto completo de la historia clínica:\n{data[:100000]}"
-    response = model.generate_content(full_prompt)
-    return response.text
+        partes = [prompt, ENCABEZADO_TEXTO_COMPLETO, data]
+    # Se hashea parte por parte, sin armar el prompt completo en un solo string
+    digest = hashlib.sha256(model_name.encode())
+    for parte in partes:
+        digest.update(b"\n")
+        digest.update(parte.encode())
+    resumir = data_format != "json" and len(data) > MAX_CARACTERES_ANALISIS
+    if resumir:
+        # El análisis sale de los resúmenes: cambiar su prompt invalida la caché
+        digest.update(PROMPT_RESUMEN_PARCIAL.encode())
+    clave = "analisis_" + digest.hexdigest()
+    cache = leer_cache(clave)
+    if cache:
+        yield cache['texto']
+        return
+    model = obtener_modelo(api_key, model_name)
+    completo = True
+    if resumir:
+        resumenes, completo = resumir_fragmentos(data, model, model_name)
+        partes = [prompt, ENCABEZADO_RESUMENES, "\n\n".join(resumenes)]
+    trozos = []
+    for trozo in model.generate_content(partes, stream=True):
+        trozos.append(trozo.text)
+        yield trozo.text
+    # Solo se guarda si la respuesta llegó completa y salió de todos los resúmenes
+    if completo:
+        guardar_cache(clave, {'texto': "".join(trozos)})
 
 # ----------------------------------------------------------------------
 # Función para crear PDF del análisis
 # ----------------------------------------------------------------------
 def crear_pdf_analisis(texto_analisis, titulo="Análisis de Historia Clínica"):
     """Genera un PDF con el texto del análisis."""
+    # fpdf2 (y Pillow detrás) se importa aquí: solo hace falta al exportar un análisis
+    from fpdf import FPDF
     pdf = FPDF()
     pdf.add_page()
     # Usar fuente Helvetica con codificación latin-1 para caracteres acentuados
@@ -604,44 +1206,328 @@ def crear_pdf_analisis(texto_analisis, titulo="Análisis de Historia Clínica"):
     
     # Contenido
     pdf.set_font("Helvetica", size=12)
-    # Dividir el texto en líneas y escribirlas
-    for linea in texto_analisis.split('\n'):
-        # Asegurar codificación
-        try:
-            pdf.multi_cell(0, 10, txt=linea.encode('latin-1', 'replace').decode('latin-1'))
-        except:
-            pdf.multi_cell(0, 10, txt=linea)
+    # Un solo multi_cell con todo el texto: ya respeta los saltos de línea, y la
+    # conversión a latin-1 (la de la fuente Helvetica) se hace una vez
+    pdf.multi_cell(0, 10, txt=texto_analisis.encode('latin-1', 'replace').decode('latin-1'))
     
-    # Devolver el PDF como bytes
-    return pdf.output(dest='S').encode('latin-1')
+    # Devolver el PDF como bytes (fpdf2 ya entrega un bytearray, sin recodificar)
+    return bytes(pdf.output())
 
 # ----------------------------------------------------------------------
 # Procesamiento principal (elige método)
 # ----------------------------------------------------------------------
-def procesar_historia(texto, metodo="regex", api_key=None, model_name=None):
+# Literales (en minúsculas) sin los cuales una sección no puede dar resultados:
+# si ninguno aparece en la historia, su extractor ni siquiera se ejecuta
+CLAVES_SECCION = {
+    'medicamentos': ('formula medica estandar', 'conciliaci', 'terapeutico'),
+    'procedimientos': ('procedimientos quirurgicos', 'procedimientos no qx'),
+    'cirugias': ('descripcion cirugia',),
+    'laboratorios': ('ordenes de laboratorio',),
+    'imagenes': ('ordenes de imagenes diagnosticas',),
+    'interconsultas': ('interconsulta por:',),
+    'evoluciones': ('evolucion medico',),
+    'altas': ('alta m',),
+}
+
+def procesar_historia(texto, metodo="regex", api_key=None, model_name=None, hash_archivo=None):
     texto = limpiar_texto(texto)
     if metodo == "regex":
+        texto_min = texto.lower()
+        presentes = {
+            seccion for seccion, claves in CLAVES_SECCION.items()
+            if any(clave in texto_min for clave in claves)
+        }
         resultado = {
             'paciente': extraer_paciente(texto),
-            'servicios': extraer_servicios(texto),
-            'diagnosticos': extraer_diagnosticos(texto),
-            'medicamentos': extraer_medicamentos(texto),
-            'procedimientos': extraer_procedimientos(texto),
-            'cirugias': extraer_cirugias(texto),
-            'laboratorios': extraer_laboratorios(texto),
-            'imagenes': extraer_imagenes(texto),
-            'interconsultas': extraer_interconsultas(texto),
-            'evoluciones': extraer_evoluciones(texto),
-            'altas': extraer_altas(texto)
+            'servicios': extraer_servicios(texto, texto_min),
+            'diagnosticos': extraer_diagnosticos(texto, texto_min),
+            'medicamentos': extraer_medicamentos(texto, texto_min) if 'medicamentos' in presentes else [],
+            'procedimientos': extraer_procedimientos(texto) if 'procedimientos' in presentes else [],
+            'cirugias': extraer_cirugias(texto, texto_min) if 'cirugias' in presentes else [],
+            'laboratorios': extraer_laboratorios(texto) if 'laboratorios' in presentes else [],
+            'imagenes': extraer_imagenes(texto) if 'imagenes' in presentes else [],
+            'interconsultas': extraer_interconsultas(texto) if 'interconsultas' in presentes else [],
+            'evoluciones': extraer_evoluciones(texto) if 'evoluciones' in presentes else [],
+            'altas': extraer_altas(texto) if 'altas' in presentes else []
         }
         return resultado
     else:  # metodo == "ia"
         if not api_key:
             st.error("Se requiere API key para extracción por IA.")
             return None
-        resultado = extract_with_gemini(texto, api_key, model_name)
+        # La llamada a Gemini es lo más costoso: se reutiliza el resultado del mismo PDF, modelo y prompt
+        clave = f"{hash_archivo}_ia_{model_name}_{VERSION_EXTRACCION_IA}" if hash_archivo else None
+        resultado = leer_cache(clave) if clave else None
+        if resultado is None:
+            resultado = extract_with_gemini(texto, api_key, model_name)
+            if resultado is not None and clave:
+                guardar_cache(clave, resultado)
         return resultado
 
+# ----------------------------------------------------------------------
+# Utilidades de presentación
+# ----------------------------------------------------------------------
+def registros(resultado, seccion):
+    """
+    Registros de una sección como lista de diccionarios. La extracción por IA puede
+    traer la sección en null o elementos sueltos que no son objetos: se ignoran.
+    """
+    return [registro for registro in (resultado.get(seccion) or []) if isinstance(registro, dict)]
+
+def campo(registro, clave, defecto='N/A'):
+    """Valor de `clave` para mostrar; `defecto` si falta, es null o está vacío."""
+    valor = registro.get(clave)
+    return defecto if valor is None or valor == '' else valor
+
+def mostrar_tabla(filas, columnas, mensaje_vacio):
+    """
+    Muestra una lista de registros como una sola tabla (un único elemento en el
+    navegador en vez de un st.write por fila). `columnas` mapea clave -> título.
+    """
+    if filas:
+        st.dataframe(
+            filas,
+            column_order=list(columnas),
+            column_config=columnas,
+            use_container_width=True,
+            hide_index=True
+        )
+    else:
+        st.write(mensaje_vacio)
+
+def paginar(elementos, clave, tamano=TAMANO_PAGINA):
+    """
+    Devuelve solo la página visible de `elementos`. Si hay más de `tamano`, muestra
+    un selector de página (`clave` debe ser única por sección) y el resto no se
+    envía al navegador.
+    """
+    if len(elementos) <= tamano:
+        return elementos
+    total_paginas = -(-len(elementos) // tamano)
+    pagina = st.number_input(
+        f"Página (de {total_paginas})", min_value=1, max_value=total_paginas, value=1, step=1, key=clave
+    )
+    inicio = (pagina - 1) * tamano
+    return elementos[inicio:inicio + tamano]
+
+@st.fragment
+def mostrar_reporte(resultado, json_bytes, nombre_archivo):
+    """
+    Muestra el reporte completo de una historia ya procesada. `json_bytes` es el
+    resultado ya serializado (se calcula una sola vez al procesar). Es un fragmento:
+    cambiar de página vuelve a dibujar solo el reporte.
+    """
+    # Cantidad de registros por sección, calculada una sola vez para encabezados y avisos
+    conteos = {
+        seccion: len(registros(resultado, seccion))
+        for seccion in (
+            'servicios', 'diagnosticos', 'medicamentos', 'procedimientos', 'cirugias',
+            'laboratorios', 'imagenes', 'interconsultas', 'evoluciones', 'altas'
+        )
+    }
+
+    # Mostrar datos del paciente
+    st.header("📋 Datos del paciente")
+    paciente = resultado.get('paciente')
+    if not isinstance(paciente, dict):
+        paciente = {}
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Nombre", campo(paciente, 'nombre', 'No encontrado'))
+    with col2:
+        st.metric("Documento", campo(paciente, 'documento', 'No encontrado'))
+    with col3:
+        st.metric("Edad", campo(paciente, 'edad', 'No encontrado'))
+    with col4:
+        st.metric("Teléfono", campo(paciente, 'telefono', 'No encontrado'))
+
+    # Servicios
+    st.header(f"🏥 Servicios de atención ({conteos['servicios']})")
+    mostrar_tabla(
+        registros(resultado, 'servicios'),
+        {'tipo_atencion': 'Tipo de atención', 'sede_nombre': 'Sede', 'fecha': 'Fecha', 'hora': 'Hora'},
+        "No se encontraron servicios."
+    )
+
+    # Diagnósticos
+    st.header(f"📌 Diagnósticos ({conteos['diagnosticos']})")
+    mostrar_tabla(
+        registros(resultado, 'diagnosticos'),
+        {'codigo': 'Código', 'descripcion': 'Descripción'},
+        "No se encontraron diagnósticos."
+    )
+
+    # Medicamentos (resumen)
+    st.header(f"💊 Medicamentos ({conteos['medicamentos']})")
+    mostrar_tabla(
+        registros(resultado, 'medicamentos'),
+        {
+            'descripcion': 'Descripción', 'cantidad': 'Cantidad', 'dosis': 'Dosis',
+            'via': 'Vía', 'frecuencia': 'Frecuencia', 'estado': 'Estado'
+        },
+        "No se encontraron medicamentos."
+    )
+
+    # Procedimientos
+    st.header(f"🩺 Procedimientos ({conteos['procedimientos']})")
+    mostrar_tabla(
+        registros(resultado, 'procedimientos'),
+        {'descripcion': 'Descripción', 'fecha': 'Fecha', 'cantidad': 'Cantidad', 'tipo': 'Tipo'},
+        "No se encontraron procedimientos."
+    )
+
+    # Cirugías detalladas
+    st.header(f"🔪 Cirugías detalladas ({conteos['cirugias']})")
+    for c in paginar(registros(resultado, 'cirugias'), 'pagina_cirugias'):
+        with st.expander(f"Cirugía del {campo(c, 'fecha', 'desconocida')}"):
+            # Todo el detalle en un solo bloque Markdown (un elemento en vez de uno por campo)
+            detalle = [
+                f"**Diagnóstico preoperatorio:** {campo(c, 'diagnostico_pre')}",
+                f"**Diagnóstico postoperatorio:** {campo(c, 'diagnostico_post')}",
+                f"**Anestesia:** {campo(c, 'anestesia')}",
+                f"**Hora inicio:** {campo(c, 'hora_inicio')} – **Hora fin:** {campo(c, 'hora_fin')}",
+                f"**Descripción:** {campo(c, 'descripcion')}",
+                f"**Tejidos a patología:** {campo(c, 'tejidos_patologia')}"
+            ]
+            participantes = [part for part in (c.get('participantes') or []) if isinstance(part, dict)]
+            if participantes:
+                detalle.append("**Participantes:**")
+                detalle.append("\n".join(f"- {campo(part, 'nombre')} ({campo(part, 'tipo')})" for part in participantes))
+            st.markdown("\n\n".join(detalle))
+    if not conteos['cirugias']:
+        st.write("No se encontraron descripciones quirúrgicas detalladas.")
+
+    # Laboratorios
+    st.header(f"🔬 Laboratorios ({conteos['laboratorios']})")
+    for lab in paginar(registros(resultado, 'laboratorios'), 'pagina_laboratorios'):
+        fecha = f" ({lab.get('fecha')})" if lab.get('fecha') else ""
+        with st.expander(f"{campo(lab, 'descripcion', 'Sin descripción')}{fecha}"):
+            detalle = f"**Cantidad:** {campo(lab, 'cantidad')}"
+            if lab.get('resultado'):
+                detalle += f"\n\n**Resultado:** {lab.get('resultado')}"
+            st.markdown(detalle)
+    if not conteos['laboratorios']:
+        st.write("No se encontraron órdenes de laboratorio.")
+
+    # Imágenes
+    st.header(f"📸 Imágenes diagnósticas ({conteos['imagenes']})")
+    for img in paginar(registros(resultado, 'imagenes'), 'pagina_imagenes'):
+        fecha = f" ({img.get('fecha')})" if img.get('fecha') else ""
+        with st.expander(f"{campo(img, 'descripcion', 'Sin descripción')}{fecha}"):
+            detalle = f"**Cantidad:** {campo(img, 'cantidad')}"
+            if img.get('resultado'):
+                detalle += f"\n\n**Resultado:** {img.get('resultado')}"
+            st.markdown(detalle)
+    if not conteos['imagenes']:
+        st.write("No se encontraron imágenes.")
+
+    # Interconsultas
+    st.header(f"📞 Interconsultas ({conteos['interconsultas']})")
+    mostrar_tabla(
+        registros(resultado, 'interconsultas'),
+        {'especialidad': 'Especialidad', 'fecha_orden': 'Fecha de orden'},
+        "No se encontraron interconsultas."
+    )
+
+    # Evoluciones (resumen)
+    st.header(f"📝 Evoluciones ({conteos['evoluciones']})")
+    st.write(f"Se encontraron {conteos['evoluciones']} notas de evolución.")
+    if not conteos['evoluciones']:
+        st.write("No se encontraron notas de evolución.")
+
+    # Altas
+    st.header(f"🚪 Altas ({conteos['altas']})")
+    mostrar_tabla(
+        registros(resultado, 'altas'),
+        {'fecha': 'Fecha'},
+        "No se encontraron registros de alta."
+    )
+
+    # JSON completo (opcional, pero lo dejamos para descarga)
+    st.header("📦 JSON completo")
+    st.download_button(
+        label="📥 Descargar JSON",
+        data=json_bytes,
+        file_name=f"{nombre_archivo.replace('.pdf', '')}_reporte_detallado.json",
+        mime="application/json"
+    )
+
+@st.fragment
+def mostrar_analisis_ia(api_key, model_name):
+    """
+    Prompt, análisis con Gemini y descarga en PDF. Es un fragmento: sus botones
+    solo vuelven a ejecutar esta sección, no el reporte completo.
+    """
+    default_prompt = (
+        "Actúa como un médico analizando una historia clínica. "
+        "Resume los hallazgos más importantes: diagnósticos principales, medicamentos prescritos, "
+        "procedimientos realizados, y cualquier evento relevante. "
+        "Identifica posibles problemas de seguridad o interacciones medicamentosas si las hay. "
+        "Proporciona un análisis estructurado."
+    )
+    user_prompt = st.text_area("✏️ Personaliza el prompt para la IA (opcional)", value=default_prompt, height=150)
+
+    data_source = st.radio("Datos a enviar a la IA", 
+                           ["Estructurados (JSON)", "Texto completo (puede ser largo)"],
+                           index=0)
+    data_format = "json" if data_source == "Estructurados (JSON)" else "text"
+
+    if st.button("🚀 Analizar con IA", type="primary"):
+        _, exceptions = cargar_gemini()
+        # Un análisis nuevo reemplaza al anterior (aunque falle)
+        st.session_state.pop('ia_response', None)
+        st.session_state.pop('ia_pdf', None)
+        with st.spinner("Consultando a Gemini..."):
+            try:
+                if data_format == "json":
+                    data_to_send = st.session_state['resultado']
+                else:
+                    data_to_send = st.session_state['texto_crudo']
+
+                # Mostrar el análisis en un recuadro a medida que llega
+                st.markdown("### Resultado del análisis")
+                with st.container(border=True):
+                    response = st.write_stream(analyze_with_gemini(
+                        data=data_to_send,
+                        prompt=user_prompt,
+                        api_key=api_key,
+                        model_name=model_name,
+                        data_format=data_format
+                    ))
+
+                # Se guarda para los reruns siguientes (descargar, paginar, etc.)
+                st.session_state['ia_response'] = response
+
+            except exceptions.ResourceExhausted as e:
+                st.error(f"Límite de cuota excedido: {e}")
+                retry_match = _RE_RETRY_DELAY.search(str(e))
+                if retry_match:
+                    seconds = int(retry_match.group(1))
+                    st.info(f"Por favor, espera {seconds} segundos antes de reintentar.")
+            except Exception as e:
+                st.error(f"Error al comunicarse con Gemini: {e}")
+    elif 'ia_response' in st.session_state:
+        # En cualquier otro rerun se muestra el último análisis sin volver a llamar a Gemini
+        st.markdown("### Resultado del análisis")
+        with st.container(border=True):
+            st.markdown(st.session_state['ia_response'])
+
+    # El PDF solo se genera si el usuario lo pide
+    if 'ia_response' in st.session_state and 'ia_pdf' not in st.session_state:
+        if st.button("📄 Generar PDF del análisis"):
+            st.session_state['ia_pdf'] = crear_pdf_analisis(
+                st.session_state['ia_response'], titulo="Análisis de Historia Clínica"
+            )
+
+    # Botón para descargar como PDF
+    if 'ia_pdf' in st.session_state:
+        st.download_button(
+            label="📥 Descargar análisis como PDF",
+            data=st.session_state['ia_pdf'],
+            file_name=f"analisis_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf",
+            mime="application/pdf"
+        )
+
 # ----------------------------------------------------------------------
 # Interfaz de Streamlit
 # ----------------------------------------------------------------------
@@ -649,6 +1535,9 @@ st.set_page_config(page_title="Lector HC con IA", page_icon="🩺", layout="wide
 st.title("🩺 Lector de Historias Clínicas + Análisis con Gemini AI")
 st.markdown("Sube un archivo PDF de una historia clínica y obtén un reporte detallado. Luego puedes usar IA para analizar los datos.")
 
+# Las entradas vencidas de la caché en disco se borran aunque no se vuelvan a pedir
+barrer_cache()
+
 # Sidebar para configuración
 with st.sidebar:
     st.header("⚙️ Configuración")
@@ -684,7 +1573,12 @@ with st.sidebar:
         model_name = None
 
     st.markdown("---")
-    st.markdown("**Nota:** Asegúrate de tener la librería instalada: `pip install google-generativeai fpdf2`")
+    st.markdown("**Nota:** Asegúrate de tener la librería instalada: `pip install google-generativeai fpdf2 pypdfium2`")
+
+    # Los textos, extracciones y análisis en caché contienen datos clínicos
+    if st.button("🗑️ Borrar caché local", help=f"La caché se borra sola a las {CACHE_TTL_SEGUNDOS // 3600} horas."):
+        borrar_cache()
+        st.success("Caché borrada")
 
 # Carga de archivo
 MAX_MB = 200
@@ -698,139 +1592,55 @@ if archivo_subido is not None:
         st.success(f"Archivo cargado: {archivo_subido.name} ({tamaño_mb:.2f} MB)")
 
         if st.button("🔍 Procesar PDF", type="primary"):
+            metodo = "ia" if extraction_method == "IA (preciso, consume tokens)" else "regex"
+            hash_archivo = hash_archivo_subido(archivo_subido)
             with st.spinner("Extrayendo texto del PDF..."):
-                texto, num_paginas = extraer_texto_pdf(archivo_subido)
+                # Con IA solo se envían MAX_CARACTERES_IA caracteres: no tiene sentido leer más páginas
+                max_chars = MAX_CARACTERES_IA if metodo == "ia" else None
+                texto, num_paginas, total_paginas = extraer_texto_pdf_con_cache(archivo_subido, hash_archivo, max_chars=max_chars)
                 if texto is None:
                     st.stop()
-                st.info(f"Se extrajeron {num_paginas} páginas.")
+                if num_paginas < total_paginas:
+                    st.info(
+                        f"Se extrajeron {num_paginas} de {total_paginas} páginas: la extracción por IA "
+                        f"solo usa los primeros {MAX_CARACTERES_IA} caracteres, así que se detuvo en la página {num_paginas}."
+                    )
+                else:
+                    st.info(f"Se extrajeron {num_paginas} páginas.")
+                # Sin capa de texto ni las reglas ni Gemini tienen con qué trabajar
+                if parece_escaneado(texto, num_paginas):
+                    st.warning("El PDF parece escaneado (casi no tiene texto seleccionable). Pásalo por un OCR y vuelve a subirlo.")
+                    st.stop()
 
             with st.spinner("Analizando información..."):
-                if extraction_method == "IA (preciso, consume tokens)" and (not api_key or not GEMINI_AVAILABLE):
+                if metodo == "ia" and (not api_key or not GEMINI_AVAILABLE):
                     st.error("No se puede usar extracción por IA: falta API key o librería.")
                     st.stop()
-                metodo = "ia" if extraction_method == "IA (preciso, consume tokens)" else "regex"
-                resultado = procesar_historia(texto, metodo=metodo, api_key=api_key, model_name=model_name)
+                resultado = procesar_historia(texto, metodo=metodo, api_key=api_key, model_name=model_name, hash_archivo=hash_archivo)
                 if resultado is None:
                     st.stop()
                 st.session_state['resultado'] = resultado
                 st.session_state['texto_crudo'] = texto
+                # Se asocia al contenido y no al nombre: otro PDF llamado igual es otra historia
+                st.session_state['hash_resultado'] = hash_archivo
+                # El JSON de descarga se serializa una vez aquí y no en cada rerun del reporte;
+                # orjson ya entrega bytes UTF-8, que se pasan tal cual al botón
+                st.session_state['json_resultado'] = orjson.dumps(
+                    resultado, default=str, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+                )
+                # El análisis con IA era del resultado anterior
+                st.session_state.pop('ia_response', None)
+                st.session_state.pop('ia_pdf', None)
+                # Un resultado nuevo empieza en la primera página de cada sección
+                for clave in [c for c in st.session_state if c.startswith('pagina_')]:
+                    del st.session_state[clave]
 
             st.success("✅ Extracción completada")
 
-            # Mostrar datos del paciente
-            st.header("📋 Datos del paciente")
-            col1, col2, col3, col4 = st.columns(4)
-            with col1:
-                st.metric("Nombre", resultado.get('paciente', {}).get('nombre', 'No encontrado'))
-            with col2:
-                st.metric("Documento", resultado.get('paciente', {}).get('documento', 'No encontrado'))
-            with col3:
-                st.metric("Edad", resultado.get('paciente', {}).get('edad', 'No encontrado'))
-            with col4:
-                st.metric("Teléfono", resultado.get('paciente', {}).get('telefono', 'No encontrado'))
-
-            # Servicios
-            st.header(f"🏥 Servicios de atención ({len(resultado.get('servicios', []))})")
-            for s in resultado.get('servicios', []):
-                st.write(f"- **{s.get('tipo_atencion')}** en {s.get('sede_nombre')} ({s.get('fecha')} {s.get('hora')})")
-            if not resultado.get('servicios'):
-                st.write("No se encontraron servicios.")
-
-            # Diagnósticos
-            st.header(f"📌 Diagnósticos ({len(resultado.get('diagnosticos', []))})")
-            for d in resultado.get('diagnosticos', []):
-                st.write(f"- **{d.get('codigo')}** {d.get('descripcion')}")
-            if not resultado.get('diagnosticos'):
-                st.write("No se encontraron diagnósticos.")
-
-            # Medicamentos (resumen)
-            st.header(f"💊 Medicamentos ({len(resultado.get('medicamentos', []))})")
-            for med in resultado.get('medicamentos', []):
-                with st.expander(f"{med.get('descripcion', '')[:80]}..."):
-                    st.write(f"**Cantidad:** {med.get('cantidad')}")
-                    st.write(f"**Dosis:** {med.get('dosis')}")
-                    st.write(f"**Vía:** {med.get('via')}")
-                    st.write(f"**Frecuencia:** {med.get('frecuencia')}")
-                    st.write(f"**Estado:** {med.get('estado')}")
-            if not resultado.get('medicamentos'):
-                st.write("No se encontraron medicamentos.")
-
-            # Procedimientos
-            st.header(f"🩺 Procedimientos ({len(resultado.get('procedimientos', []))})")
-            for p in resultado.get('procedimientos', []):
-                fecha = f" ({p.get('fecha')})" if p.get('fecha') else ""
-                st.write(f"- **{p.get('descripcion')}** {fecha} – Cantidad: {p.get('cantidad')} ({p.get('tipo')})")
-            if not resultado.get('procedimientos'):
-                st.write("No se encontraron procedimientos.")
-
-            # Cirugías detalladas
-            st.header(f"🔪 Cirugías detalladas ({len(resultado.get('cirugias', []))})")
-            for c in resultado.get('cirugias', []):
-                with st.expander(f"Cirugía del {c.get('fecha', 'desconocida')}"):
-                    st.write(f"**Diagnóstico preoperatorio:** {c.get('diagnostico_pre', 'N/A')}")
-                    st.write(f"**Diagnóstico postoperatorio:** {c.get('diagnostico_post', 'N/A')}")
-                    st.write(f"**Anestesia:** {c.get('anestesia', 'N/A')}")
-                    st.write(f"**Hora inicio:** {c.get('hora_inicio', 'N/A')} – **Hora fin:** {c.get('hora_fin', 'N/A')}")
-                    st.write(f"**Descripción:** {c.get('descripcion', 'N/A')}")
-                    st.write(f"**Tejidos a patología:** {c.get('tejidos_patologia', 'N/A')}")
-                    if 'participantes' in c:
-                        st.write("**Participantes:**")
-                        for part in c['participantes']:
-                            st.write(f"  - {part.get('nombre')} ({part.get('tipo')})")
-            if not resultado.get('cirugias'):
-                st.write("No se encontraron descripciones quirúrgicas detalladas.")
-
-            # Laboratorios
-            st.header(f"🔬 Laboratorios ({len(resultado.get('laboratorios', []))})")
-            for lab in resultado.get('laboratorios', []):
-                fecha = f" ({lab.get('fecha')})" if lab.get('fecha') else ""
-                with st.expander(f"{lab.get('descripcion')}{fecha}"):
-                    st.write(f"**Cantidad:** {lab.get('cantidad')}")
-                    if lab.get('resultado'):
-                        st.write(f"**Resultado:** {lab.get('resultado')}")
-            if not resultado.get('laboratorios'):
-                st.write("No se encontraron órdenes de laboratorio.")
-
-            # Imágenes
-            st.header(f"📸 Imágenes diagnósticas ({len(resultado.get('imagenes', []))})")
-            for img in resultado.get('imagenes', []):
-                fecha = f" ({img.get('fecha')})" if img.get('fecha') else ""
-                with st.expander(f"{img.get('descripcion')}{fecha}"):
-                    st.write(f"**Cantidad:** {img.get('cantidad')}")
-                    if img.get('resultado'):
-                        st.write(f"**Resultado:** {img.get('resultado')}")
-            if not resultado.get('imagenes'):
-                st.write("No se encontraron imágenes.")
-
-            # Interconsultas
-            st.header(f"📞 Interconsultas ({len(resultado.get('interconsultas', []))})")
-            for ic in resultado.get('interconsultas', []):
-                st.write(f"- **{ic.get('especialidad')}** (orden: {ic.get('fecha_orden')})")
-            if not resultado.get('interconsultas'):
-                st.write("No se encontraron interconsultas.")
-
-            # Evoluciones (resumen)
-            st.header(f"📝 Evoluciones ({len(resultado.get('evoluciones', []))})")
-            st.write(f"Se encontraron {len(resultado.get('evoluciones', []))} notas de evolución.")
-            if not resultado.get('evoluciones'):
-                st.write("No se encontraron notas de evolución.")
-
-            # Altas
-            st.header(f"🚪 Altas ({len(resultado.get('altas', []))})")
-            for a in resultado.get('altas', []):
-                st.write(f"- Alta del {a.get('fecha')}")
-            if not resultado.get('altas'):
-                st.write("No se encontraron registros de alta.")
-
-            # JSON completo (opcional, pero lo dejamos para descarga)
-            st.header("📦 JSON completo")
-            json_str = json.dumps(resultado, indent=2, ensure_ascii=False, default=str)
-            st.download_button(
-                label="📥 Descargar JSON",
-                data=json_str,
-                file_name=f"{archivo_subido.name.replace('.pdf', '')}_reporte_detallado.json",
-                mime="application/json"
-            )
+        # El reporte se dibuja desde session_state: sigue visible al cambiar de página o
+        # usar cualquier otro widget, sin volver a procesar el PDF
+        if 'resultado' in st.session_state and st.session_state.get('hash_resultado') == hash_archivo_subido(archivo_subido):
+            mostrar_reporte(st.session_state['resultado'], st.session_state['json_resultado'], archivo_subido.name)
 
 # Sección de análisis con IA (siempre visible si hay resultado)
 if 'resultado' in st.session_state:
@@ -842,59 +1652,4 @@ if 'resultado' in st.session_state:
     elif not api_key:
         st.warning("Ingresa una API key de Gemini en la barra lateral para usar esta función.")
     else:
-        default_prompt = (
-            "Actúa como un médico analizando una historia clínica. "
-            "Resume los hallazgos más importantes: diagnósticos principales, medicamentos prescritos, "
-            "procedimientos realizados, y cualquier evento relevante. "
-            "Identifica posibles problemas de seguridad o interacciones medicamentosas si las hay. "
-            "Proporciona un análisis estructurado."
-        )
-        user_prompt = st.text_area("✏️ Personaliza el prompt para la IA (opcional)", value=default_prompt, height=150)
-        
-        data_source = st.radio("Datos a enviar a la IA", 
-                               ["Estructurados (JSON)", "Texto completo (puede ser largo)"],
-                               index=0)
-        data_format = "json" if data_source == "Estructurados (JSON)" else "text"
-        
-        if st.button("🚀 Analizar con IA", type="primary"):
-            with st.spinner("Consultando a Gemini..."):
-                try:
-                    if data_format == "json":
-                        data_to_send = st.session_state['resultado']
-                    else:
-                        data_to_send = st.session_state['texto_crudo']
-                    
-                    response = analyze_with_gemini(
-                        data=data_to_send,
-                        prompt=user_prompt,
-                        api_key=api_key,
-                        model_name=model_name,
-                        data_format=data_format
-                    )
-                    
-                    # Mostrar el análisis en un recuadro
-                    st.markdown("### Resultado del análisis")
-                    with st.container():
-                        st.markdown(f"""
-                        <div style="border: 2px solid #4CAF50; border-radius: 10px; padding: 15px; background-color: #f9f9f9;">
-                            {response.replace(chr(10), '<br>')}
-                        </div>
-                        """, unsafe_allow_html=True)
-                    
-                    # Botón para descargar como PDF
-                    pdf_bytes = crear_pdf_analisis(response, titulo="Análisis de Historia Clínica")
-                    st.download_button(
-                        label="📥 Descargar análisis como PDF",
-                        data=pdf_bytes,
-                        file_name=f"analisis_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf",
-                        mime="application/pdf"
-                    )
-                    
-                except exceptions.ResourceExhausted as e:
-                    st.error(f"Límite de cuota excedido: {e}")
-                    retry_match = re.search(r'retry_delay \{ seconds: (\d+) \}', str(e))
-                    if retry_match:
-                        seconds = int(retry_match.group(1))
-                        st.info(f"Por favor, espera {seconds} segundos antes de reintentar.")
-                except Exception as e:
-                    st.error(f"Error al comunicarse con Gemini: {e}")
+        mostrar_analisis_ia(api_key, model_name)
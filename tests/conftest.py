@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# app.py es un script de Streamlit en la raíz del repositorio, no un paquete
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
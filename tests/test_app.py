@@ -0,0 +1,202 @@
+"""
+Pruebas de las funciones puras de app.py. Importar app ejecuta el script de
+Streamlit en modo "bare" (sin servidor): los widgets devuelven sus valores por
+defecto y no se procesa ningún PDF.
+"""
+import hashlib
+import io
+import os
+import time
+
+import pytest
+
+import app
+
+
+# ----------------------------------------------------------------------
+# Caché en disco
+# ----------------------------------------------------------------------
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    directorio = tmp_path / "hc_cache"
+    monkeypatch.setattr(app, "CACHE_DIR", directorio)
+    return directorio
+
+
+def test_cache_ida_y_vuelta(cache_dir):
+    app.guardar_cache("clave", {"texto": "ñandú", "num_paginas": 3})
+    assert app.leer_cache("clave") == {"texto": "ñandú", "num_paginas": 3}
+    assert app.leer_cache("otra") is None
+    # Sin temporales huérfanos
+    assert [p.name for p in cache_dir.iterdir()] == ["clave.json"]
+
+
+@pytest.mark.skipif(not hasattr(os, "getuid"), reason="permisos POSIX")
+def test_cache_carpeta_privada(cache_dir):
+    app.guardar_cache("clave", {"a": 1})
+    assert cache_dir.stat().st_mode & 0o777 == 0o700
+    # Si otros pueden escribir en la carpeta, no se lee nada de ella
+    cache_dir.chmod(0o777)
+    assert app.leer_cache("clave") is None
+    cache_dir.chmod(0o700)
+    assert app.leer_cache("clave") == {"a": 1}
+
+
+def test_cache_vencida(cache_dir):
+    app.guardar_cache("clave", {"a": 1})
+    viejo = time.time() - app.CACHE_TTL_SEGUNDOS - 1
+    os.utime(cache_dir / "clave.json", (viejo, viejo))
+    assert app.leer_cache("clave") is None
+    assert not (cache_dir / "clave.json").exists()
+
+
+def test_cache_limite_de_tamano(cache_dir, monkeypatch):
+    monkeypatch.setattr(app, "CACHE_MAX_BYTES", 250)
+    for n, clave in enumerate(["a", "b", "c"]):
+        app.guardar_cache(clave, {"x": "y" * 100})
+        momento = time.time() - 10 + n
+        os.utime(cache_dir / f"{clave}.json", (momento, momento))
+    app.limpiar_cache()
+    # Se borran primero las más antiguas
+    assert sorted(p.name for p in cache_dir.iterdir()) == ["b.json", "c.json"]
+
+
+def test_texto_pdf_con_cache_por_hash_y_limite(cache_dir, monkeypatch):
+    llamadas = []
+
+    def extraer(archivo_pdf, max_chars=None):
+        llamadas.append(max_chars)
+        return "texto", 2, 5
+
+    monkeypatch.setattr(app, "extraer_texto_pdf", extraer)
+    assert app.extraer_texto_pdf_con_cache(None, "abc", max_chars=10) == ("texto", 2, 5)
+    assert app.extraer_texto_pdf_con_cache(None, "abc", max_chars=10) == ("texto", 2, 5)
+    # Otro límite u otro archivo es otra entrada
+    app.extraer_texto_pdf_con_cache(None, "abc")
+    app.extraer_texto_pdf_con_cache(None, "def", max_chars=10)
+    assert llamadas == [10, None, 10]
+
+
+def test_hash_archivo_sin_file_digest(monkeypatch):
+    datos = os.urandom(3 * (1 << 20) + 7)
+    esperado = hashlib.sha256(datos).hexdigest()
+    archivo = io.BytesIO(datos)
+    assert app.generar_hash_archivo(archivo) == esperado
+    monkeypatch.delattr(hashlib, "file_digest", raising=False)
+    assert app.generar_hash_archivo(archivo) == esperado
+    assert archivo.tell() == 0
+
+
+# ----------------------------------------------------------------------
+# Limpieza y recorte del texto
+# ----------------------------------------------------------------------
+def test_limpiar_texto_conserva_saltos_de_pagina():
+    assert app.limpiar_texto("fin\x0cALTA MEDICA\x00\n\n\nx\x0by") == "fin\nALTA MEDICA\nx\ny"
+
+
+def test_bloques_seccion():
+    texto = "X\nMARCA uno\nENCABEZADO\nresto\nMARCA dos"
+    assert app.bloques_seccion(texto, "MARCA") == [" uno", " dos"]
+    assert app.bloques_seccion(texto, app.re.compile("MARCA")) == [" uno", " dos"]
+    # Con texto_busqueda el marcador se busca en la copia y se recorta el original
+    assert app.bloques_seccion(texto, "marca", texto.lower()) == [" uno", " dos"]
+    assert app.bloques_seccion(texto, "NADA") == []
+
+
+def test_buscar_servicios_equivale_al_patron():
+    texto = (
+        "sede de atencion suelta\n"
+        "SEDE DE ATENCION 001 CLINICA CENTRAL FOLIO 12 FECHA 01/02/2024 10:00:00 TIPO DE ATENCION : URGENCIAS\n"
+        "Sede de Atencion 002 SEDE NORTE FOLIO 3 FECHA 05/02/2024 08:30:00 TIPO DE ATENCION: HOSPITALIZACION\n"
+    )
+    esperado = [m.groups() for m in app._RE_SERVICIO.finditer(texto)]
+    assert len(esperado) == 2
+    assert [m.groups() for m in app.buscar_servicios(texto, texto.lower())] == esperado
+    assert app.extraer_servicios(texto, texto.lower()) == app.extraer_servicios(texto)
+
+
+# ----------------------------------------------------------------------
+# Extracción con IA (sin llamadas a Gemini)
+# ----------------------------------------------------------------------
+def test_dividir_texto_ia():
+    texto = "".join(f"SEDE DE ATENCION {n}\n" + "linea\n" * 50 for n in range(20))
+    fragmentos = app.dividir_texto_ia(texto, tamano=1000)
+    assert "".join(fragmentos) == texto
+    assert all(len(f) <= 1000 for f in fragmentos)
+    # Los cortes caen al inicio de una atención
+    assert all(f.startswith("SEDE DE ATENCION") for f in fragmentos)
+    assert app.dividir_texto_ia("corto", tamano=1000) == ["corto"]
+
+
+def test_combinar_extracciones():
+    partes = [
+        {"paciente": {"nombre": "ANA", "documento": None}, "medicamentos": [{"d": 1}]},
+        {"paciente": {"nombre": "OTRA", "documento": "123"}, "medicamentos": [{"d": 2}], "altas": []},
+    ]
+    assert app.combinar_extracciones(partes) == {
+        "paciente": {"nombre": "ANA", "documento": "123"},
+        "medicamentos": [{"d": 1}, {"d": 2}],
+        "altas": [],
+    }
+
+
+def test_extraer_json_respuesta():
+    assert app.extraer_json_respuesta('{"a": [1, 2]}') == {"a": [1, 2]}
+    assert app.extraer_json_respuesta('Aquí está:\n```json\n{"a": 1}\n```\nFin') == {"a": 1}
+
+
+def test_extraer_json_respuesta_con_fence_dentro_de_un_valor():
+    contenido = (
+        'Resultado:\n```json\n'
+        '{"observaciones": "nota con ``` adentro", "altas": [{"fecha": "01/02/2024"}]}\n'
+        '```\nListo.'
+    )
+    assert app.extraer_json_respuesta(contenido) == {
+        "observaciones": "nota con ``` adentro",
+        "altas": [{"fecha": "01/02/2024"}],
+    }
+    # Un texto sin JSON sigue fallando con el error que espera extract_with_gemini
+    with pytest.raises(app.json.JSONDecodeError):
+        app.extraer_json_respuesta("sin json")
+
+
+# ----------------------------------------------------------------------
+# Reporte con secciones nulas (extracción por IA)
+# ----------------------------------------------------------------------
+def test_registros_y_campo_toleran_nulos():
+    resultado = {"cirugias": None, "laboratorios": [None, "texto", {"descripcion": "HEMOGRAMA"}]}
+    assert app.registros(resultado, "cirugias") == []
+    assert app.registros(resultado, "imagenes") == []
+    assert app.registros(resultado, "laboratorios") == [{"descripcion": "HEMOGRAMA"}]
+    assert app.campo({"nombre": None}, "nombre", "No encontrado") == "No encontrado"
+    assert app.campo({"nombre": ""}, "nombre") == "N/A"
+    assert app.campo({"edad": 0}, "edad") == 0
+
+
+def test_mostrar_reporte_con_secciones_nulas():
+    # mostrar_reporte es un st.fragment; fuera de `streamlit run` se prueba la función original
+    mostrar_reporte = app.mostrar_reporte.__wrapped__
+    resultado = {seccion: None for seccion in (*app.CLAVES_SECCION, "servicios", "diagnosticos")}
+    resultado["paciente"] = None
+    mostrar_reporte(resultado, b"{}", "historia.pdf")
+    resultado.update({
+        "paciente": {"nombre": None, "edad": None},
+        "cirugias": [None, {"fecha": None, "participantes": None}, {"participantes": [None, {"nombre": "DR X"}]}],
+        "laboratorios": [{"descripcion": None, "cantidad": None}, 3],
+        "imagenes": [None],
+        "altas": [None, {"fecha": "01/02/2024"}],
+    })
+    mostrar_reporte(resultado, b"{}", "historia.pdf")
+
+
+# ----------------------------------------------------------------------
+# Modelo de Gemini por API key (no hace llamadas de red)
+# ----------------------------------------------------------------------
+def test_obtener_modelo_ata_cada_modelo_a_su_api_key():
+    pytest.importorskip("google.generativeai")
+    obtener_modelo = app.obtener_modelo.__wrapped__
+    modelo_a = obtener_modelo("KEY_A", "gemini-2.0-flash")
+    modelo_b = obtener_modelo("KEY_B", "gemini-2.0-flash")
+    # Configurar B después no debe cambiar el cliente ya atado a A
+    assert modelo_a._client._client_options.api_key == "KEY_A"
+    assert modelo_b._client._client_options.api_key == "KEY_B"